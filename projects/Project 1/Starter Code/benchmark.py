@@ -0,0 +1,368 @@
+"""Benchmarks of the LQ3K simulator
+
+    python benchmark.py scaling 22 1 2 4 8
+        times evolve and simulate_run of one circuit for every number of workers
+
+    python benchmark.py suite --output results.json [--baseline old.json]
+        times construction, get_unitary, evolve and simulate_run of every circuit
+        family over a range of qubit counts, with peak RSS, next to qiskit-aer on
+        the same circuits if it is installed. Every case runs --repeat times and
+        its fastest timings count. With a baseline, exits with status 1 if any
+        LQ3K timing got slower by more than --threshold percent (or than the
+        spread of its runs, if that is larger), or a case failed
+
+Every suite case runs in a fresh subprocess, so that its peak RSS is its own."""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from p1 import LQ3K
+
+
+def random_circuit(num_qubits, depth, rng=None, **options):
+    """Returns a statevector LQ3K of depth layers of random h/t/cx gates"""
+    rng = np.random.default_rng(rng)
+    circuit = LQ3K(num_qubits, mode="statevector", **options)
+    for _ in range(depth):
+        for qubit in range(num_qubits):
+            [circuit.h, circuit.t][rng.integers(2)](qubit)
+        for qubit in rng.permutation(num_qubits)[: num_qubits // 2]:
+            circuit.cx(qubit, (qubit + 1 + rng.integers(num_qubits - 1)) % num_qubits)
+    return circuit
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def parallel_scaling(num_qubits, worker_counts, depth=4, shots=1000):
+    """Times evolve and simulate_run of the same random circuit for every number of
+    workers, returns a list of (workers, evolve seconds, simulate_run seconds)"""
+    initial_state = np.zeros(2**num_qubits)
+    initial_state[0] = 1
+    results = []
+    for workers in worker_counts:
+        circuit = random_circuit(num_qubits, depth, rng=0, workers=workers)
+        evolve = timed(circuit.evolve, initial_state)
+        run = timed(circuit.simulate_run, initial_state, shots=shots, rng=0)
+        results.append((workers, evolve, run))
+    return results
+
+
+# circuit families of the suite, as lists of (gate, *qubits), ("cp", angle,
+# control, target) or ("qft", start, k) in LQ3K qubit numbering
+
+
+def clifford_t_ops(num_qubits, depth=10, rng=0):
+    """depth layers of random h/s/t on every qubit followed by random cx pairs"""
+    rng = np.random.default_rng(rng)
+    ops = []
+    for _ in range(depth):
+        for qubit in range(num_qubits):
+            ops.append((("h", "s", "t")[rng.integers(3)], qubit))
+        order = rng.permutation(num_qubits)
+        for pair in range(num_qubits // 2):
+            ops.append(("cx", order[2 * pair], order[2 * pair + 1]))
+    return ops
+
+
+def ghz_ops(num_qubits):
+    return [("h", 0)] + [("cx", qubit, qubit + 1) for qubit in range(num_qubits - 1)]
+
+
+def cx_ladder_ops(num_qubits, rounds=4):
+    """h on every qubit, then rounds of cx between qubits half the register apart"""
+    half = max(num_qubits // 2, 1)
+    ops = [("h", qubit) for qubit in range(num_qubits)]
+    for _ in range(rounds):
+        for qubit in range(num_qubits):
+            ops.append(("cx", qubit, (qubit + half) % num_qubits))
+    return [op for op in ops if op[0] != "cx" or op[1] != op[2]]
+
+
+def qft_ops(num_qubits):
+    """textbook QFT: h and controlled phases, then the swaps reversing the order"""
+    ops = []
+    for target in range(num_qubits):
+        ops.append(("h", target))
+        for control in range(target + 1, num_qubits):
+            ops.append(("cp", np.pi / 2 ** (control - target), control, target))
+    for qubit in range(num_qubits // 2):
+        ops.append(("swap", qubit, num_qubits - 1 - qubit))
+    return ops
+
+
+def qft_fft_ops(num_qubits):
+    """the same QFT as one native LQ3K.qft"""
+    return [("h", qubit) for qubit in range(num_qubits)] + [("qft", 0, num_qubits)]
+
+
+FAMILIES = {
+    "clifford_t": clifford_t_ops,
+    "ghz": ghz_ops,
+    "cx_ladder": cx_ladder_ops,
+    "qft": qft_ops,
+    "qft_fft": qft_fft_ops,
+}
+
+# get_unitary is skipped above this, the dense unitary grows as 4^n
+UNITARY_MAX_QUBITS = 12
+
+SHOTS = 1024
+
+
+def to_lq3k(ops, num_qubits, mode="statevector"):
+    circuit = LQ3K(num_qubits, mode=mode)
+    for name, *args in ops:
+        if name == "cp":
+            angle, control, target = args
+            circuit.cu(np.diag([1, np.exp(1j * angle)]), [control], target)
+        else:
+            getattr(circuit, name)(*args)
+    return circuit
+
+
+def to_qiskit(ops, num_qubits):
+    """The same circuit as a QuantumCircuit; LQ3K qubit i is qiskit qubit n-1-i"""
+    from qiskit import QuantumCircuit
+    from qiskit.circuit.library import QFTGate
+
+    circuit = QuantumCircuit(num_qubits)
+    for name, *args in ops:
+        if name == "qft":
+            start, k = args
+            # LQ3K qubit start is the most significant, i.e. the last Qiskit qubit
+            circuit.append(QFTGate(k), range(num_qubits - start - k, num_qubits - start))
+        elif name == "cp":
+            angle, control, target = args
+            circuit.cp(angle, num_qubits - 1 - control, num_qubits - 1 - target)
+        else:
+            getattr(circuit, name)(*[num_qubits - 1 - int(qubit) for qubit in args])
+    return circuit
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_lq3k_case(family, num_qubits):
+    ops = FAMILIES[family](num_qubits)
+    result = {"gates": len(ops)}
+    result["construct"] = timed(to_lq3k, ops, num_qubits)
+    if num_qubits <= UNITARY_MAX_QUBITS:
+        result["get_unitary"] = timed(to_lq3k(ops, num_qubits, "unitary").get_unitary)
+    initial_state = np.zeros(2**num_qubits)
+    initial_state[0] = 1
+    result["evolve"] = timed(to_lq3k(ops, num_qubits).evolve, initial_state)
+    circuit = to_lq3k(ops, num_qubits)
+    result["simulate_run"] = timed(circuit.simulate_run, 0, shots=SHOTS, rng=0)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_aer_case(family, num_qubits):
+    from qiskit import transpile
+    from qiskit_aer import AerSimulator
+
+    ops = FAMILIES[family](num_qubits)
+    simulator = AerSimulator(method="statevector")
+    result = {"gates": len(ops)}
+    start = time.perf_counter()
+    circuit = to_qiskit(ops, num_qubits)
+    result["construct"] = time.perf_counter() - start
+    if num_qubits <= UNITARY_MAX_QUBITS:
+        unitary = AerSimulator(method="unitary")
+        circuit_unitary = circuit.copy()
+        circuit_unitary.save_unitary()
+        start = time.perf_counter()
+        unitary.run(transpile(circuit_unitary, unitary)).result()
+        result["get_unitary"] = time.perf_counter() - start
+    circuit_state = circuit.copy()
+    circuit_state.save_statevector()
+    start = time.perf_counter()
+    simulator.run(transpile(circuit_state, simulator)).result()
+    result["evolve"] = time.perf_counter() - start
+    circuit.measure_all()
+    start = time.perf_counter()
+    simulator.run(transpile(circuit, simulator), shots=SHOTS, seed_simulator=0).result()
+    result["simulate_run"] = time.perf_counter() - start
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_case(engine, family, num_qubits, timeout=None):
+    """Runs one case in a subprocess, returns its result dict (with an "error" key
+    instead of timings if it failed or timed out)"""
+    command = [sys.executable, __file__, "case", engine, family, str(num_qubits)]
+    try:
+        process = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {"error": f"timed out after {timeout} s"}
+    if process.returncode:
+        lines = process.stderr.strip().splitlines()
+        if lines:
+            return {"error": lines[-1]}
+        # e.g. SIGKILL from the OOM killer leaves nothing on stderr
+        if process.returncode < 0:
+            return {"error": f"killed by signal {-process.returncode}"}
+        return {"error": f"exited with status {process.returncode}"}
+    return json.loads(process.stdout)
+
+
+def run_repeated(engine, family, num_qubits, timeout=None, repeat=3):
+    """Runs one case repeat times, returns the result of run_case with the fastest
+    of every timing, and in result["spread"] how much slower (in percent) its
+    slowest run was, i.e. the noise of that timing. Returns the first error"""
+    runs = []
+    for _ in range(repeat):
+        result = run_case(engine, family, num_qubits, timeout)
+        if "error" in result:
+            return result
+        runs.append(result)
+    best = dict(runs[0], spread={})
+    best["peak_rss_mb"] = max(run["peak_rss_mb"] for run in runs)
+    for timing in TIMINGS:
+        if timing in best:
+            values = [run[timing] for run in runs]
+            best[timing] = min(values)
+            best["spread"][timing] = 100 * (max(values) / min(values) - 1)
+    return best
+
+
+def aer_available():
+    try:
+        import qiskit_aer  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def run_suite(families, qubit_counts, aer=True, timeout=None, repeat=3):
+    """Returns a list of result dicts, one per (engine, family, qubit count), each
+    the best of repeat runs (see run_repeated)"""
+    engines = ["lq3k"] + (["aer"] if aer and aer_available() else [])
+    results = []
+    for family in families:
+        for num_qubits in qubit_counts:
+            for engine in engines:
+                result = run_repeated(engine, family, num_qubits, timeout, repeat)
+                result.update(engine=engine, family=family, num_qubits=num_qubits)
+                results.append(result)
+                print(json.dumps(result), file=sys.stderr)
+    return results
+
+
+TIMINGS = ("construct", "get_unitary", "evolve", "simulate_run")
+
+
+def regressions(results, baseline, threshold, min_seconds=0.01):
+    """Returns a message for every LQ3K timing that is more than threshold percent
+    slower than in baseline, or more than the spread of its runs in either of
+    them if that is larger; timings below min_seconds in the baseline are noise.
+    A case the baseline has timings for but that failed, timed out or is missing
+    from results is a regression too"""
+    previous = {
+        (result["family"], result["num_qubits"]): result
+        for result in baseline
+        if result["engine"] == "lq3k" and any(timing in result for timing in TIMINGS)
+    }
+    messages = []
+    for result in results:
+        if result["engine"] != "lq3k":
+            continue
+        old = previous.pop((result["family"], result["num_qubits"]), None)
+        if old is None:
+            continue
+        case = f"{result['family']} on {result['num_qubits']} qubits"
+        if "error" in result:
+            messages.append(f"{case}: {result['error']}")
+            continue
+        for timing in TIMINGS:
+            if timing in old and timing not in result:
+                messages.append(f"{case}: no {timing} timing")
+                continue
+            if timing not in result or old.get(timing, 0) < min_seconds:
+                continue
+            change = 100 * (result[timing] / old[timing] - 1)
+            noise = max(
+                old.get("spread", {}).get(timing, 0),
+                result.get("spread", {}).get(timing, 0),
+            )
+            if change > max(threshold, noise):
+                messages.append(
+                    f"{case}: {timing} "
+                    f"{old[timing]:.4f} s -> {result[timing]:.4f} s (+{change:.0f}%)"
+                )
+    for family, num_qubits in previous:
+        messages.append(f"{family} on {num_qubits} qubits: missing from the results")
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    scaling = commands.add_parser("scaling")
+    scaling.add_argument("num_qubits", type=int)
+    scaling.add_argument("workers", type=int, nargs="+")
+    suite = commands.add_parser("suite")
+    suite.add_argument("--families", nargs="+", default=list(FAMILIES))
+    suite.add_argument(
+        "--qubits", type=int, nargs="+", default=[2, 4, 8, 12, 16, 20, 24]
+    )
+    suite.add_argument("--no-aer", action="store_true")
+    suite.add_argument("--timeout", type=float, help="seconds allowed per case")
+    suite.add_argument("--output", help="JSON file to write the results to")
+    suite.add_argument("--baseline", help="JSON results of an earlier run")
+    suite.add_argument(
+        "--threshold", type=float, default=25, help="allowed slowdown in percent"
+    )
+    suite.add_argument(
+        "--repeat", type=int, default=3, help="runs per case, the fastest counts"
+    )
+    case = commands.add_parser("case")
+    case.add_argument("engine", choices=["lq3k", "aer"])
+    case.add_argument("family", choices=list(FAMILIES))
+    case.add_argument("num_qubits", type=int)
+    args = parser.parse_args()
+
+    if args.command == "scaling":
+        results = parallel_scaling(args.num_qubits, args.workers)
+        base_evolve, base_run = results[0][1:]
+        print("workers  evolve (s)  speedup  simulate_run (s)  speedup")
+        for workers, evolve, run in results:
+            print(
+                "%7d  %10.3f  %7.2f  %16.3f  %7.2f"
+                % (workers, evolve, base_evolve / evolve, run, base_run / run)
+            )
+    elif args.command == "case":
+        run = run_lq3k_case if args.engine == "lq3k" else run_aer_case
+        print(json.dumps(run(args.family, args.num_qubits)))
+    else:
+        results = run_suite(
+            args.families, args.qubits, not args.no_aer, args.timeout, args.repeat
+        )
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent=1)
+        else:
+            print(json.dumps(results, indent=1))
+        if args.baseline:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+            messages = regressions(results, baseline, args.threshold)
+            for message in messages:
+                print("REGRESSION: " + message, file=sys.stderr)
+            if messages:
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
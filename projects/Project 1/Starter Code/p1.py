@@ -1,18 +1,490 @@
 import numpy as np
 from sympy import matrix2numpy
 import random
+import itertools
+import hashlib
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from stabilizer import StabilizerTableau
+
+
+# matrices of the built-in gates, shared by every instruction that uses them
+GATES = {
+    "x": np.array([[0, 1], [1, 0]]),
+    "y": np.array([[0, -1j], [1j, 0]]),
+    "z": np.array([[1, 0], [0, -1]]),
+    "h": np.array([[1, 1], [1, -1]]) / np.sqrt(2),
+    "t": np.array([[1, 0], [0, np.exp(1j * np.pi / 4)]]),
+    "tdg": np.array([[1, 0], [0, np.exp(-1j * np.pi / 4)]]),
+    "s": np.array([[1, 0], [0, 1j]]),
+    "sdg": np.array([[1, 0], [0, -1j]]),
+    "swap": np.array([[1, 0, 0, 0], [0, 0, 1, 0], [0, 1, 0, 0], [0, 0, 0, 1]]),
+}
+
+# gates the stabilizer backend can simulate
+CLIFFORD_GATES = {"x", "y", "z", "h", "s", "sdg", "cx", "swap"}
+
+# one entry of the gate log of a circuit: gate name, tuple of qubits it acts on
+# (in the order of the matrix axes), its matrix and the qubits that control it.
+# Measurements and resets have no matrix (None), measurements write clbits
+Instruction = namedtuple(
+    "Instruction",
+    ["name", "qubits", "matrix", "controls", "clbits"],
+    defaults=((), ()),
+)
+
+# instructions of the gate log that are not unitary gates
+NON_UNITARY = {"measure", "reset"}
+
+
+class _FourierMatrix:
+    """Stands in for the 2^k x 2^k matrix of the QFT (or its inverse) on k qubits in
+    the gate log: gate applications run it as an FFT (see _fourier), and the dense
+    matrix is only built if something asks for it with numpy.asarray"""
+
+    ndim = 2
+
+    def __init__(self, num_qubits, inverse=False):
+        self.num_qubits = num_qubits
+        self.inverse = inverse
+        self.shape = (2**num_qubits, 2**num_qubits)
+
+    def __array__(self, dtype=None, copy=None):
+        # column j is the transform of basis state j
+        transform = np.fft.fft if self.inverse else np.fft.ifft
+        matrix = transform(np.identity(self.shape[0]), axis=0, norm="ortho")
+        return matrix if dtype is None else matrix.astype(dtype)
+
+    def __repr__(self):
+        return f"_FourierMatrix({self.num_qubits}, inverse={self.inverse})"
+
+
+def _contract(psi, gate, axes, out):
+    """Contract a 2^k x 2^k gate against the given axes of the rank-n tensor psi,
+    writing the result into out (same shape as psi, must not overlap it)"""
+    k = len(axes)
+    gate = gate.reshape((2,) * (2 * k))
+    # the input legs of the gate share their labels with the target axes of psi,
+    # the output legs take the place of those axes in out
+    labels = list(range(psi.ndim))
+    out_labels = list(labels)
+    for leg, axis in enumerate(axes):
+        out_labels[axis] = psi.ndim + leg
+    gate_labels = [psi.ndim + leg for leg in range(k)] + list(axes)
+    np.einsum(gate, gate_labels, psi, labels, out_labels, out=out)
+
+
+def _fourier(psi, fourier, axes, out):
+    """Apply the _FourierMatrix fourier to the consecutive axes of psi as a single
+    FFT along them, writing the result into out; the first axis is the most
+    significant bit of the transformed register, like the first leg of a gate"""
+    first = axes[0]
+    assert list(axes) == list(range(first, first + len(axes)))
+    shape = psi.shape[:first] + (-1,) + psi.shape[first + len(axes) :]
+    # the QFT has the e^(+2 pi i xy / N) kernel of numpy's inverse FFT
+    transform = np.fft.fft if fourier.inverse else np.fft.ifft
+    result = transform(psi.reshape(shape), axis=first, norm="ortho")
+    out[...] = result.reshape(out.shape)
+
+
+def _apply_tensor(psi, gate, qubits, controls, target):
+    """Apply gate to the given qubit axes of the tensor psi, writing into target
+
+    psi and target may be strided views (e.g. one chunk of a larger state); any axes
+    that are not named in qubits or controls are carried along untouched."""
+    contract = _contract
+    if isinstance(gate, _FourierMatrix):
+        contract = _fourier
+    else:
+        gate = np.asarray(gate, dtype=target.dtype)
+    if gate.ndim == 1:
+        # put the phase axes in ascending qubit order and broadcast them over psi
+        phases = np.transpose(gate.reshape((2,) * len(qubits)), np.argsort(qubits))
+        shape = [1] * psi.ndim
+        for qubit in qubits:
+            shape[qubit] = 2
+        np.multiply(psi, phases.reshape(shape), out=target)
+    elif not controls:
+        contract(psi, gate, qubits, target)
+    else:
+        target[...] = psi
+        index = tuple(
+            1 if axis in controls else slice(None) for axis in range(psi.ndim)
+        )
+        # fixing the control axes removes them, so the target axes shift down
+        targets = [qubit - sum(c < qubit for c in controls) for qubit in qubits]
+        contract(psi[index], gate, targets, target[index])
+
+
+def _apply_gate(state, gate, qubits, controls=(), out=None):
+    """Apply a 2^k x 2^k gate to the given qubits of state, without broadcasting it
+    to the full register
+
+    state has shape (2**n, ...) where any trailing axes are carried along untouched
+    (e.g. the columns of a unitary). The first axis is viewed as a rank-n tensor with
+    one axis of size 2 per qubit (qubit 0 is the most significant bit) and the gate is
+    contracted only against the axes of the target qubits, which costs O(2^n * 2^k)
+    instead of the O(8^n) of a kron-broadcast matrix product. If controls are given,
+    the gate is only applied to the slice of the tensor where all of them are 1.
+    Neither cost depends on how far apart the qubits are. A 1-D gate is the diagonal
+    of a diagonal gate and is applied as an elementwise phase multiplication.
+
+    The result is written into out (a contiguous array shaped like state that does
+    not overlap it) if given, so callers can reuse the same buffers gate after gate;
+    the gate is cast to out's dtype.
+
+    Returns: out, or a new array if out is None"""
+    num_qubits = state.shape[0].bit_length() - 1
+    psi = state.reshape((2,) * num_qubits + state.shape[1:])
+    if out is None:
+        # a lazy QFT is complex but has no dtype of its own
+        gate_type = np.complex64 if isinstance(gate, _FourierMatrix) else gate
+        out = np.empty(state.shape, np.result_type(state, gate_type))
+    _apply_tensor(psi, gate, qubits, controls, out.reshape(psi.shape))
+    return out
+
+
+def _apply_gate_chunked(state, instruction, out, pool, chunk_qubits):
+    """Apply instruction to state, writing into out, as independent tasks on pool
+
+    The amplitudes are split into 2^chunk_qubits contiguous chunks by the values of
+    the leading (most significant) qubits, and one task is submitted per value of
+    the chunk qubits the gate does not act on. A gate whose qubits are all below the
+    chunk qubits is therefore applied to every chunk on its own, a gate on chunk
+    qubits pairs up the chunks that differ only in those qubits (2^j chunks for j
+    of them) and contracts them together. Controls on chunk qubits never couple
+    chunks: chunks where the control is 0 are just copied. Tasks write disjoint
+    parts of out, so they need no locking, and numpy releases the GIL in the
+    kernels, so a thread pool runs them in parallel on the shared arrays."""
+    num_qubits = state.shape[0].bit_length() - 1
+    psi = state.reshape((2,) * num_qubits + state.shape[1:])
+    target = out.reshape(psi.shape)
+    qubits, controls = instruction.qubits, instruction.controls
+    fixed = [qubit for qubit in range(chunk_qubits) if qubit not in qubits]
+    # fixing axes removes them, so the remaining axes shift down
+    qubits = [qubit - sum(f < qubit for f in fixed) for qubit in qubits]
+    local_controls = [c for c in controls if c not in fixed]
+    local_controls = [c - sum(f < c for f in fixed) for c in local_controls]
+
+    def task(values):
+        index = [slice(None)] * psi.ndim
+        for qubit, value in zip(fixed, values):
+            index[qubit] = value
+        index = tuple(index)
+        if any(index[c] == 0 for c in controls if c in fixed):
+            target[index] = psi[index]
+        else:
+            _apply_tensor(
+                psi[index], instruction.matrix, qubits, local_controls, target[index]
+            )
+
+    # list() waits for every task and re-raises their exceptions
+    list(pool.map(task, itertools.product((0, 1), repeat=len(fixed))))
+    return out
+
+
+def _plan_pass(gates, num_qubits, block_qubits):
+    """Returns (number of gates, resident qubits) of the next blocked pass over gates
+
+    A pass holds block_qubits qubits resident in memory and streams the state block
+    by block, one block per value of the other qubits. It can apply every gate whose
+    targets are resident: controls and diagonal phases on the other qubits are fixed
+    within a block. As many leading gates as fit are taken, and the resident set is
+    filled up with the least significant qubits so blocks are read in long runs."""
+    needed = set()
+    count = 0
+    for instruction in gates:
+        mixing = set() if np.ndim(instruction.matrix) == 1 else set(instruction.qubits)
+        if len(needed | mixing) > block_qubits:
+            break
+        needed |= mixing
+        count += 1
+    if not count:
+        raise ValueError(
+            f"{gates[0].name} on qubits {gates[0].qubits} does not fit in a block of "
+            f"{block_qubits} qubits"
+        )
+    resident = set(needed)
+    for qubit in reversed(range(num_qubits)):
+        if len(resident) == block_qubits:
+            break
+        resident.add(qubit)
+    return count, sorted(resident)
+
+
+def _apply_to_block(block, instructions, fixed):
+    """Apply instructions to one block of a blocked pass (see _plan_pass)
+
+    block is the contiguous tensor of the resident qubits (in ascending order) for
+    the values fixed maps the other qubits to.
+
+    Returns: block or the work buffer, whichever holds the result"""
+    buffers = [block, np.empty_like(block)]
+
+    def shift(qubit):
+        return qubit - sum(other < qubit for other in fixed)
+
+    step = 0
+    for instruction in instructions:
+        if any(fixed.get(control) == 0 for control in instruction.controls):
+            # identity on this block
+            continue
+        controls = [shift(c) for c in instruction.controls if c not in fixed]
+        matrix, qubits = instruction.matrix, instruction.qubits
+        if np.ndim(matrix) == 1:
+            # keep the phases of the fixed values of the fixed qubits
+            index = tuple(fixed.get(qubit, slice(None)) for qubit in qubits)
+            matrix = np.reshape(matrix, (2,) * len(qubits))[index].reshape(-1)
+            qubits = [qubit for qubit in qubits if qubit not in fixed]
+        _apply_tensor(
+            buffers[step % 2],
+            matrix,
+            [shift(qubit) for qubit in qubits],
+            controls,
+            buffers[(step + 1) % 2],
+        )
+        step += 1
+    return buffers[step % 2]
+
+
+def _gates_digest(instructions):
+    """Fingerprint of a gate log, to recognise the gates a checkpoint was made with"""
+    digest = hashlib.sha256()
+    for instruction in instructions:
+        digest.update(repr((instruction.name, instruction.qubits)).encode())
+        digest.update(repr(tuple(instruction.controls)).encode())
+        if isinstance(instruction.matrix, _FourierMatrix):
+            digest.update(repr(instruction.matrix).encode())
+        else:
+            matrix = np.asarray(instruction.matrix, dtype=np.complex128)
+            digest.update(matrix.tobytes())
+    return digest.hexdigest()
+
+
+def _write_json(path, data):
+    """Replace the JSON file at path atomically, so a crash leaves the old version"""
+    with open(path + ".tmp", "w") as file:
+        json.dump(data, file)
+    os.replace(path + ".tmp", path)
+
+
+def _is_diagonal(instruction):
+    """Whether instruction only changes the phases of basis states"""
+    if instruction.matrix is None or isinstance(instruction.matrix, _FourierMatrix):
+        return False
+    matrix = np.asarray(instruction.matrix)
+    if matrix.ndim == 1:
+        return True
+    return not np.any(matrix - np.diag(np.diagonal(matrix)))
+
+
+def _block(instructions, qubits, diagonal):
+    """Returns the 2^k x 2^k matrix of instructions applied in order on the k given
+    qubits, or just its diagonal (phase vector) if diagonal is set"""
+    # the phases of a diagonal are its image of the all-ones vector, the matrix of
+    # a block is its image of the identity
+    if diagonal:
+        block = np.ones(2 ** len(qubits), dtype=complex)
+    else:
+        block = np.identity(2 ** len(qubits), dtype=complex)
+    for instruction in instructions:
+        block = _apply_gate(
+            block,
+            instruction.matrix,
+            tuple(qubits.index(qubit) for qubit in instruction.qubits),
+            tuple(qubits.index(qubit) for qubit in instruction.controls),
+        )
+    return block
+
+
+def _merge(first, second, max_qubits, max_diagonal_qubits):
+    """Returns one Instruction equivalent to first followed by second, or None if
+    the merged gate would act on too many qubits
+
+    Two diagonal gates merge into a diagonal (a phase vector over the union of
+    their qubits), anything else into a dense block on the union of their qubits."""
+    if first.matrix is None or second.matrix is None:
+        # gates never move across a measurement or reset
+        return None
+    qubits = sorted(set(first.qubits + first.controls + second.qubits + second.controls))
+    diagonal = _is_diagonal(first) and _is_diagonal(second)
+    if len(qubits) > (max_diagonal_qubits if diagonal else max_qubits):
+        return None
+    block = _block((first, second), qubits, diagonal)
+    return Instruction("diagonal" if diagonal else "fused", tuple(qubits), block)
+
+
+def _monomial(matrix):
+    """Returns (rows, phases) if the gate maps every basis state j to a single basis
+    state, phases[j] |rows[j]>, or None if it does not (e.g. h, measure)"""
+    if matrix is None or isinstance(matrix, _FourierMatrix):
+        return None
+    matrix = np.asarray(matrix)
+    if matrix.ndim == 1:
+        return np.arange(len(matrix)), matrix
+    nonzero = matrix != 0
+    if np.any(nonzero.sum(axis=0) != 1):
+        return None
+    rows = nonzero.argmax(axis=0)
+    return rows, matrix[rows, np.arange(len(rows))]
+
+
+def _apply_monomial(permutation, phases, monomial, qubits, controls, num_qubits):
+    """Compose a monomial gate (see _monomial) into the circuit U|i> =
+    phases[i] |permutation[i]>, updating both arrays in place with O(2^n) index
+    arithmetic on the basis state integers"""
+    gate_rows, gate_phases = monomial
+    wires = controls + qubits
+    # tables over every value of (controls, qubits), with the controls as the most
+    # significant bits; the gate does nothing unless all controls are 1
+    size = 2 ** len(wires)
+    active = np.arange(size) >> len(qubits) == 2 ** len(controls) - 1
+    local = np.arange(size) & (2 ** len(qubits) - 1)
+    rows = np.where(active, gate_rows[local] | (np.arange(size) - local), np.arange(size))
+    phase_table = np.where(active, gate_phases[local], 1)
+    # read the wires of every basis state out of the permutation
+    index = np.zeros_like(permutation)
+    for wire in wires:
+        index <<= 1
+        index |= (permutation >> (num_qubits - 1 - wire)) & 1
+    if np.any(rows != np.arange(size)):
+        # bits of the basis state that flip, spread back to the wire positions
+        flips = np.zeros(size, dtype=permutation.dtype)
+        for position, wire in enumerate(wires):
+            flipped = ((rows ^ np.arange(size)) >> (len(wires) - 1 - position)) & 1
+            flips |= flipped.astype(permutation.dtype) << (num_qubits - 1 - wire)
+        permutation ^= flips[index]
+    if np.any(phase_table != 1):
+        phases *= phase_table[index]
+
+
+def _sample_rows(probabilities, shots, rng):
+    """Draw shots outcomes from every row of the (batch, k) probabilities array in
+    one vectorized inverse-CDF lookup
+
+    The rows' CDFs are offset by their row number and concatenated, so a single
+    searchsorted handles the whole batch. Returns a (batch, shots) int array."""
+    batch, size = probabilities.shape
+    offsets = np.arange(batch)[:, np.newaxis]
+    cdf = np.cumsum(probabilities, axis=1) + offsets
+    draws = rng.random((batch, shots)) + offsets
+    outcomes = np.searchsorted(cdf.reshape(-1), draws.reshape(-1), side="right")
+    outcomes = outcomes.reshape(batch, shots) - offsets * size
+    # rounding can leave the last CDF entry a hair below 1
+    return np.minimum(outcomes, size - 1)
+
+
+def _bits_to_ints(bits):
+    """Turn rows of measured bits (most significant first) into integers; Python
+    ints in an object array if they do not fit in an int64"""
+    width = bits.shape[-1]
+    if width < 63:
+        return bits.astype(np.int64) @ (1 << np.arange(width - 1, -1, -1))
+    return np.array(
+        [int("".join(map(str, row)), 2) for row in bits.tolist()], dtype=object
+    )
+
+
+def _counts_dict(counts):
+    """Turn an array of per-outcome counts into a Qiskit-style counts dict"""
+    width = len(counts).bit_length() - 1
+    return {
+        format(outcome, f"0{width}b"): int(counts[outcome])
+        for outcome in np.flatnonzero(counts)
+    }
+
+
+def _marginal(probabilities, qubits):
+    """Returns the probabilities of measuring the integers over qubits (qubits[0]
+    most significant), summing the other qubits of the 2^n probabilities out on
+    their rank-n view; a 2-D stack gives one row per state"""
+    batch_shape = probabilities.shape[:-1]
+    batch_axes = len(batch_shape)
+    num_qubits = probabilities.shape[-1].bit_length() - 1
+    tensor = probabilities.reshape(batch_shape + (2,) * num_qubits)
+    others = tuple(
+        batch_axes + axis for axis in range(num_qubits) if axis not in qubits
+    )
+    marginal = tensor.sum(axis=others)
+    # sum keeps the remaining axes in ascending order, put them in qubits order
+    order = [batch_axes + rank for rank in np.argsort(np.argsort(qubits))]
+    marginal = np.transpose(marginal, list(range(batch_axes)) + order)
+    return marginal.reshape(batch_shape + (-1,))
+
+
+def _unitary_runs(gates, start, stop, skip):
+    """Yields (begin, end) index ranges covering gates[start:stop] except the
+    indices in skip"""
+    begin = start
+    for index in range(start, stop):
+        if index in skip:
+            if begin < index:
+                yield begin, index
+            begin = index + 1
+    if begin < stop:
+        yield begin, stop
+
+
+def _merge_branches(states, values, counts, tolerance=1e-9):
+    """Merge the branches (rows of states, classical values and shot counts) that
+    have the same classical value and the same state up to a phase"""
+    keep = np.ones(len(states), dtype=bool)
+    for value in set(values.tolist()):
+        group = np.flatnonzero(values == value)
+        if len(group) < 2:
+            continue
+        overlaps = np.abs(states[group].conj() @ states[group].T)
+        for i, first in enumerate(group):
+            if not keep[first]:
+                continue
+            same = group[i + 1 :][overlaps[i, i + 1 :] > 1 - tolerance]
+            same = same[keep[same]]
+            counts[first] += counts[same].sum()
+            keep[same] = False
+    return states[keep], values[keep], counts[keep]
 
 
 class LQ3K:
     """Create a new circuit with the specified number of qubits and no gates.
 
     Circuit supports limited measuring capabilities: all qubits are automatically measured
-    at the end of the circuit when running "simulate_run"
+    at the end of the circuit when running "simulate_run". Alternatively, measure
+    and reset can be used anywhere in the circuit, measuring into num_clbits
+    classical bits, and run samples the circuit with Qiskit-style counts (see also
+    from_qiskit and run_sim); such circuits have no unitary and cannot be evolved
+
+    Gates are only recorded when they are added (see self.gates); the circuit is
+    compiled the first time get_unitary, evolve or simulate_run needs it, and the
+    result is cached. Gates appended afterwards are folded into the cached unitary
+    instead of recomputing it from scratch.
 
     Args:
         num_qubits: total number of quantum bits in the circuit (can't be modified after
         initialization)
 
+        mode: "unitary" (default) evolves states with the compiled 2^n x 2^n unitary of
+        the circuit, which is cheapest when the same circuit is evolved many times.
+        "statevector" applies the recorded gates one by one to the 2^n amplitude array
+        passed to evolve/simulate_run, so memory stays O(2^n) and the unitary is only
+        built when get_unitary is called
+
+        dtype: numpy.complex128 (default) or numpy.complex64, used for every state,
+        unitary and gate application of the circuit; complex64 halves memory
+
+        max_bytes: memory budget; evolve, simulate_run and get_unitary raise
+        MemoryBudgetExceeded before allocating anything if estimate_memory says they
+        would need more than this. None (default) means no limit
+
+        workers: number of threads gates are applied with (default 1). With more
+        than one, the amplitude array is split into chunks on its leading qubits and
+        every gate is applied to the chunks in parallel (see _apply_gate_chunked);
+        registers below PARALLEL_MIN_QUBITS are always simulated serially
+
+        num_clbits: number of classical bits, written by measure and read by run
+
         Example:
             qc = LQ3K(2)
             qc.cx(0, 1)
@@ -28,17 +500,632 @@ class LQ3K:
 
     # contain a state vector and a unitary matrix
 
+    MODES = ("unitary", "statevector")
+
+    DTYPES = (np.complex64, np.complex128)
+
+    # how far the norm of an initial state may be from 1
+    NORM_TOLERANCE = 1e-8
+
+    # smaller registers are not worth splitting across threads
+    PARALLEL_MIN_QUBITS = 14
+
+    # qubits held in memory at once by evolve_to_file, 64 MiB blocks of complex128
+    BLOCK_QUBITS = 22
+
     class InvalidStateVector(Exception):
         """Not a valid state vector"""
 
-    def __init__(self, num_qubits):
+    class MemoryBudgetExceeded(Exception):
+        """An operation would need more memory than max_bytes allows"""
+
+    class CheckpointMismatch(Exception):
+        """A state file was written by a different circuit"""
+
+    class UnsupportedInstruction(Exception):
+        """A Qiskit instruction has no LQ3K equivalent"""
+
+    class NonUnitaryCircuit(Exception):
+        """The circuit measures or resets qubits, so it has no unitary to evolve
+        states with; use run"""
+
+    def __init__(
+        self,
+        num_qubits,
+        mode="unitary",
+        dtype=np.complex128,
+        max_bytes=None,
+        workers=1,
+        num_clbits=0,
+    ):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown mode {mode!r}, expected one of {self.MODES}")
+        if np.dtype(dtype) not in self.DTYPES:
+            raise ValueError(f"Unsupported dtype {dtype!r}, expected complex64/128")
         self.num_qubits = num_qubits
-        self.state_vector = np.zeros(2**num_qubits)
-        self.unitary = np.identity(2**num_qubits)
+        self.mode = mode
+        self.dtype = np.dtype(dtype)
+        self.max_bytes = max_bytes
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        self.workers = workers
+        self.num_clbits = num_clbits
+        # state run starts from if it is given none, |0...0> if None
+        self.initial_state = None
+        # last state produced by evolve
+        self.state_vector = None
+        # gate log, list of Instruction in circuit order
+        self.gates = []
+        # cached product of self.gates[:self._compiled_gates]
+        self._unitary = None
+        self._compiled_gates = 0
+        # same for the (permutation, phases) form of the circuit, False once a gate
+        # that is not a permutation with phases shows up
+        self._permutation = None
+        self._permuted_gates = 0
+        # the circuit without its terminal measurements, for run (see _unitary_body)
+        self._body = None
+        self._body_key = None
+
+    @property
+    def unitary(self):
+        return self.get_unitary()
+
+    def _append(self, name, matrix, *qubits, controls=(), clbits=()):
+        """Record gate acting on qubits (controlled by controls, writing clbits) at
+        the end of the circuit"""
+        for qubit in qubits + controls:
+            assert 0 <= qubit < self.num_qubits
+        assert len(set(qubits + controls)) == len(qubits + controls)
+        self.gates.append(Instruction(name, qubits, matrix, controls, clbits))
+
+    @classmethod
+    def from_qiskit(cls, circuit, **options):
+        """Returns: an LQ3K equivalent to the Qiskit QuantumCircuit circuit
+
+        Qiskit numbers its qubits little-endian, so Qiskit qubit k becomes LQ3K qubit
+        n-1-k; state vectors and basis state indices are then the same in both.
+        Built-in gates map to their LQ3K method, controlled gates (cx, ccx, mcx, cz,
+        cp, open controls, ...) to a controlled instruction, other gates on up to two
+        qubits to their matrix, and anything else is translated through its
+        definition. initialize/set_statevector on fresh qubits set initial_state,
+        measurements and resets map to measure and reset, barriers are skipped.
+
+        Args:
+            circuit: qiskit.QuantumCircuit
+            options: passed on to LQ3K, e.g. mode="statevector"
+
+        Example:
+            qc = QuantumCircuit(2, 2)
+            qc.h(0)
+            qc.cx(0, 1)
+            qc.measure([0, 1], [0, 1])
+            LQ3K.from_qiskit(qc).run(1000) # {'00': 491, '11': 509}
+
+        Raises:
+            UnsupportedInstruction: For instructions that have no LQ3K equivalent
+            (classical control, initialize after the start, parameters)"""
+        lq3k = cls(circuit.num_qubits, num_clbits=circuit.num_clbits, **options)
+        qubits = [
+            circuit.num_qubits - 1 - circuit.find_bit(qubit).index
+            for qubit in circuit.qubits
+        ]
+        clbits = [circuit.find_bit(clbit).index for clbit in circuit.clbits]
+        # qubits that are still |0>, which initialize and reset can act on
+        fresh = set(range(circuit.num_qubits))
+        lq3k._translate(circuit, qubits, clbits, fresh)
+        return lq3k
+
+    def _translate(self, circuit, qubits, clbits, fresh):
+        """Append the instructions of the Qiskit circuit, whose qubits/clbits are
+        self's qubits/clbits (LQ3K numbering)"""
+        from qiskit.circuit import ControlledGate, Gate
+        from qiskit.quantum_info import Statevector
+
+        def unsupported(operation, why):
+            return self.UnsupportedInstruction(f"{operation.name}: {why}")
+
+        self._global_phase(circuit.global_phase)
+        for item in circuit.data:
+            operation = item.operation
+            targets = [qubits[circuit.find_bit(q).index] for q in item.qubits]
+            name = operation.name
+            if name in ("barrier", "delay"):
+                continue
+            if name == "measure":
+                clbit = clbits[circuit.find_bit(item.clbits[0]).index]
+                self.measure(targets[0], clbit)
+                continue
+            if getattr(operation, "condition", None) is not None:
+                raise unsupported(operation, "classical control is not supported")
+            if name == "reset":
+                if targets[0] not in fresh:
+                    self.reset(targets[0])
+                continue
+            if name in ("initialize", "set_statevector"):
+                if not set(targets) <= fresh:
+                    raise unsupported(operation, "only initializes fresh qubits")
+                if name == "initialize":
+                    # reset every qubit then prepare the state
+                    vector = Statevector(operation.definition.data[-1].operation)
+                else:
+                    vector = Statevector(operation.params[0])
+                self._prepare(targets, vector.data)
+                fresh -= set(targets)
+                continue
+            fresh -= set(targets)
+            if isinstance(operation, Gate) and operation.is_parameterized():
+                raise unsupported(operation, "unbound parameters")
+            if isinstance(operation, ControlledGate):
+                num_controls = operation.num_ctrl_qubits
+                controls, gate_qubits = targets[:num_controls], targets[num_controls:]
+                # open controls are closed controls between x gates
+                flips = [
+                    qubit
+                    for bit, qubit in enumerate(controls)
+                    if not operation.ctrl_state >> bit & 1
+                ]
+                for qubit in flips:
+                    self.x(qubit)
+                base = operation.base_gate
+                if base.name == "x" and num_controls == 1:
+                    self.cx(controls[0], gate_qubits[0])
+                elif base.name == "x" and num_controls == 2:
+                    self.ccx(*controls, gate_qubits[0])
+                else:
+                    matrix = GATES.get(base.name)
+                    if matrix is None:
+                        matrix = base.to_matrix()
+                    if hasattr(operation, "__array__"):
+                        # a gate with its own matrix can carry a phase its base
+                        # gate does not (CUGate's gamma): take the controlled block
+                        block = [
+                            operation.ctrl_state | target << num_controls
+                            for target in range(2 ** len(gate_qubits))
+                        ]
+                        own = operation.to_matrix()[np.ix_(block, block)]
+                        if not np.allclose(own, base.to_matrix()):
+                            matrix = own
+                    self._append(
+                        name,
+                        matrix,
+                        *reversed(gate_qubits),
+                        controls=tuple(controls),
+                    )
+                for qubit in flips:
+                    self.x(qubit)
+            elif name in GATES:
+                getattr(self, name)(*targets)
+            elif name in ("qft", "qft_dg") and targets == list(
+                range(targets[0], targets[0] - len(targets), -1)
+            ):
+                # qargs[0] is the least significant bit of the register in Qiskit
+                self.qft(targets[-1], len(targets), inverse=name == "qft_dg")
+            elif (
+                isinstance(operation, Gate)
+                and (operation.num_qubits <= 2 or operation.definition is None)
+                and hasattr(operation, "to_matrix")
+            ):
+                # Qiskit matrices take the first qubit as least significant
+                self._append(name, operation.to_matrix(), *reversed(targets))
+            elif operation.definition is not None:
+                definition = operation.definition
+                self._translate(
+                    definition,
+                    [targets[definition.find_bit(q).index] for q in definition.qubits],
+                    [
+                        clbits[circuit.find_bit(item.clbits[i]).index]
+                        for i in range(len(item.clbits))
+                    ],
+                    fresh,
+                )
+            else:
+                raise unsupported(operation, "no matrix or definition")
+
+    def _global_phase(self, phase):
+        """Append a global phase of e^(i phase)"""
+        if phase:
+            self._append("global_phase", np.full(2, np.exp(1j * float(phase))), 0)
+
+    def _prepare(self, qubits, vector):
+        """Replace the |0> of the (so far untouched) qubits in initial_state with
+        vector, which takes qubits[0] as its least significant bit like Qiskit"""
+        num_qubits = self.num_qubits
+        state = self.initial_state
+        if state is None:
+            state = np.zeros(2**num_qubits, dtype=complex)
+            state[0] = 1
+        state = np.reshape(state, (2,) * num_qubits)
+        rest = [qubit for qubit in range(num_qubits) if qubit not in qubits]
+        index = tuple(0 if qubit in qubits else slice(None) for qubit in range(num_qubits))
+        vector = np.reshape(vector, (2,) * len(qubits))
+        state = np.einsum(
+            state[index], rest, vector, list(reversed(qubits)), list(range(num_qubits))
+        )
+        self.initial_state = state.reshape(-1)
+
+    def measure(self, qubit, clbit):
+        """Measures qubit in the computational basis into classical bit clbit; see
+        run"""
+        assert 0 <= clbit < self.num_clbits
+        self._append("measure", None, qubit, clbits=(clbit,))
+
+    def reset(self, qubit):
+        """Resets qubit to |0>, i.e. measures it and flips it back if it was 1"""
+        self._append("reset", None, qubit)
+
+    def _check_unitary(self):
+        """Raises NonUnitaryCircuit if the gate log has measurements or resets"""
+        if any(instruction.name in NON_UNITARY for instruction in self.gates):
+            raise self.NonUnitaryCircuit(
+                "The circuit measures or resets qubits, use run instead"
+            )
+
+    def _terminal_measurements(self):
+        """Returns the indices in self.gates of the measurements that nothing acts
+        on afterwards and whose clbit no later measurement overwrites; they commute
+        to the end of the circuit"""
+        touched = set()
+        written = set()
+        terminal = []
+        for index in reversed(range(len(self.gates))):
+            instruction = self.gates[index]
+            qubits = set(instruction.qubits + instruction.controls)
+            if instruction.name == "measure":
+                if not qubits & touched and instruction.clbits[0] not in written:
+                    terminal.append(index)
+                written.add(instruction.clbits[0])
+            touched |= qubits
+        return terminal[::-1]
+
+    def _unitary_body(self, terminal):
+        """Returns a copy of the circuit without the measurements at the indices
+        terminal, cached (with its compiled unitary) until the gate log changes"""
+        key = (id(self.gates), len(self.gates))
+        if self._body is None or self._body_key != key:
+            terminal = set(terminal)
+            body = LQ3K(
+                self.num_qubits,
+                mode=self.mode,
+                dtype=self.dtype,
+                max_bytes=self.max_bytes,
+                workers=self.workers,
+            )
+            body.gates = [
+                instruction
+                for index, instruction in enumerate(self.gates)
+                if index not in terminal
+            ]
+            self._body, self._body_key = body, key
+        return self._body
+
+    def run(self, shots, initial_state=None, rng=None):
+        """Samples shots runs of the circuit from initial_state (self.initial_state
+        or |0...0> by default) and counts the values of the classical bits
+
+        Measurements that nothing acts on afterwards are sampled from the final
+        state. If every measurement is like that, the circuit is evolved once,
+        through the usual evolve/tableau paths. Otherwise the shots are split into
+        outcome branches: every mid-circuit measurement or reset splits each branch
+        in two, dividing its shots binomially by the outcome probabilities and
+        dropping outcomes no shot takes. Every distinct branch is evolved once, all
+        of them as one batch, and branches that end up with the same classical bits
+        and the same state (up to phase) merge again. Repeated rounds over many
+        shots therefore cost as much as the distinct branches, not the shots.
+
+        Example:
+            qc = LQ3K(2, num_clbits=2)
+            qc.h(0)
+            qc.measure(0, 0)
+            qc.reset(0)
+            qc.cx(0, 1)
+            qc.measure(1, 1)
+            qc.run(1000) # {'00': 507, '01': 493}
+
+        Returns: Qiskit-style counts dict, num_clbits wide bitstrings with clbit 0
+            on the right; bits that are never measured read 0
+
+        Raises:
+            InvalidStateVector: When initial_state is not unit length."""
+        rng = np.random.default_rng(rng)
+        if initial_state is None:
+            initial_state = 0 if self.initial_state is None else self.initial_state
+        terminal = set(self._terminal_measurements())
+        measured = [self.gates[index] for index in sorted(terminal)]
+        qubits = sorted({instruction.qubits[0] for instruction in measured})
+        dtype = np.int64 if self.num_clbits < 63 else object
+        if not any(
+            instruction.name in NON_UNITARY
+            for index, instruction in enumerate(self.gates)
+            if index not in terminal
+        ):
+            branches = [(np.zeros((), dtype=dtype), shots, initial_state)]
+            body = self._unitary_body(terminal)
+        else:
+            branches = self._run_branches(initial_state, shots, terminal, dtype, rng)
+            body = None
+        counts = {}
+        for value, branch_shots, state in branches:
+            outcomes = np.full(branch_shots, value, dtype=dtype)
+            if qubits:
+                if body is not None:
+                    memory = body.simulate_run(state, branch_shots, qubits, rng, True)
+                else:
+                    probabilities = _marginal(np.abs(state) ** 2, qubits)
+                    probabilities /= probabilities.sum()
+                    memory = rng.choice(len(probabilities), branch_shots, p=probabilities)
+                for instruction in measured:
+                    position = len(qubits) - 1 - qubits.index(instruction.qubits[0])
+                    bit = (memory >> position & 1).astype(dtype)
+                    clbit = instruction.clbits[0]
+                    outcomes = outcomes & ~(1 << clbit) | bit << clbit
+            values, value_counts = np.unique(outcomes, return_counts=True)
+            for value, count in zip(values.tolist(), value_counts.tolist()):
+                key = format(value, f"0{self.num_clbits}b")
+                counts[key] = counts.get(key, 0) + count
+        return counts
+
+    def _run_branches(self, initial_state, shots, terminal, dtype, rng):
+        """Runs the circuit except for the terminal measurements on outcome
+        branches (see run)
+
+        Returns: list of (classical bits, shots, state vector) of the branches"""
+        size = 2**self.num_qubits
+        if np.ndim(initial_state) == 0:
+            state = np.zeros(size, dtype=self.dtype)
+            state[initial_state] = 1
+        else:
+            state = np.asarray(initial_state)
+            if not np.isclose(np.linalg.norm(state), 1, rtol=0, atol=1e-6):
+                raise self.InvalidStateVector("Initial state is not unit length")
+            state = state.astype(self.dtype)
+        # one row per branch
+        states = state[np.newaxis]
+        values = np.zeros(1, dtype=dtype)
+        counts = np.array([shots])
+        start = 0
+        for index, instruction in enumerate(self.gates + [None]):
+            if instruction is not None and (
+                instruction.name not in NON_UNITARY or index in terminal
+            ):
+                continue
+            # apply the gates since the last measurement or reset, skipping any
+            # terminal measurements among them
+            for begin, stop in _unitary_runs(self.gates, start, index, terminal):
+                states = self._apply_gates(
+                    np.ascontiguousarray(states.T), begin, stop
+                ).T
+            start = index + 1
+            if instruction is None:
+                break
+            qubit = instruction.qubits[0]
+            tensor = states.reshape(len(states), 2**qubit, 2, -1)
+            ones = np.einsum("bxy,bxy->b", tensor[:, :, 1].conj(), tensor[:, :, 1]).real
+            ones_shots = rng.binomial(counts, np.clip(ones, 0, 1))
+            outcomes = []
+            for outcome, outcome_shots, probability in (
+                (0, counts - ones_shots, 1 - ones),
+                (1, ones_shots, ones),
+            ):
+                keep = outcome_shots > 0
+                if not keep.any():
+                    continue
+                projected = np.zeros_like(tensor[keep])
+                # a reset moves the 1 outcome back to |0>
+                slot = 0 if instruction.name == "reset" else outcome
+                projected[:, :, slot] = tensor[keep][:, :, outcome]
+                projected /= np.sqrt(probability[keep]).reshape(-1, 1, 1, 1)
+                branch_values = values[keep]
+                if instruction.name == "measure":
+                    clbit = instruction.clbits[0]
+                    branch_values = branch_values & ~(1 << clbit) | outcome << clbit
+                outcomes.append(
+                    (projected.reshape(-1, size), branch_values, outcome_shots[keep])
+                )
+            states = np.concatenate([branch[0] for branch in outcomes])
+            values = np.concatenate([branch[1] for branch in outcomes])
+            counts = np.concatenate([branch[2] for branch in outcomes])
+            states, values, counts = _merge_branches(states, values, counts)
+        return list(zip(values, counts.tolist(), states))
+
+    def _invalidate(self):
+        """Drop the compiled unitary, e.g. after self.gates was rewritten"""
+        self._unitary = None
+        self._compiled_gates = 0
+        self._permutation = None
+        self._permuted_gates = 0
+        self._body = None
+
+    def _is_permutation(self):
+        """Whether the circuit can be compiled to its permutation form (see
+        _compile_permutation), without compiling it"""
+        if self._permutation is False:
+            return False
+        new_gates = self.gates[self._permuted_gates :]
+        return all(_monomial(instruction.matrix) is not None for instruction in new_gates)
+
+    def estimate_memory(self, operation="evolve", batch=1, block_qubits=None):
+        """Returns: estimated peak number of bytes of the arrays allocated by
+        operation ("evolve", which simulate_run also uses, "get_unitary" or
+        "evolve_to_file") on this circuit, for a stack of batch initial states
+        (evolve) or with blocks of block_qubits qubits (evolve_to_file)
+
+        Example:
+            qc = LQ3K(20, mode="statevector", dtype=np.complex64)
+            qc.h(0)
+            qc.estimate_memory() # 25165824: input, output and work buffer
+            qc.estimate_memory("get_unitary") # 17592186044416"""
+        size = 2**self.num_qubits
+        item = self.dtype.itemsize
+        if operation == "evolve_to_file":
+            if block_qubits is None:
+                block_qubits = self.BLOCK_QUBITS
+            # the block read from disk and its work buffer, the state stays on disk
+            return 2 * 2 ** min(self.num_qubits, block_qubits) * item
+        states = size * batch * item
+        # dense unitary plus the work buffer it is compiled through
+        compiled = 2 * size * size * item
+        if self._is_permutation():
+            index = 4 if self.num_qubits < 31 else 8
+            # permutation, phases and the gate lookup index
+            compiled = size * (2 * index + item)
+            if operation == "get_unitary":
+                return compiled + size * size * item
+        if operation == "get_unitary":
+            return compiled
+        if operation != "evolve":
+            raise ValueError(f"Unknown operation {operation!r}")
+        if self.mode == "statevector" and not self._is_permutation():
+            # converted input and the two buffers gates are applied through
+            return 3 * states
+        return compiled + 2 * states
+
+    def _check_memory(self, operation, batch=1, block_qubits=None):
+        """Raises MemoryBudgetExceeded if operation would not fit in max_bytes"""
+        if self.max_bytes is None:
+            return
+        needed = self.estimate_memory(operation, batch, block_qubits)
+        if needed > self.max_bytes:
+            raise self.MemoryBudgetExceeded(
+                f"{operation} on {self.num_qubits} qubits needs about {needed} bytes, "
+                f"over the budget of {self.max_bytes} bytes"
+            )
+
+    def _compile(self):
+        """Bring the cached unitary up to date with the gate log and return it"""
+        if self._unitary is None:
+            self._unitary = np.identity(2**self.num_qubits, dtype=self.dtype)
+            self._compiled_gates = 0
+        self._unitary = self._apply_gates(self._unitary, self._compiled_gates)
+        self._compiled_gates = len(self.gates)
+        return self._unitary
+
+    def _apply_gates(self, state, start=0, stop=None):
+        """Apply self.gates[start:stop] to state (shape (2^n, ...), self.dtype)
+
+        Gates are applied back and forth between state and a single work buffer
+        allocated up front, instead of allocating a new product for every gate.
+        With workers > 1 each gate is applied chunk by chunk on a thread pool.
+
+        Returns: state or the work buffer, whichever holds the result"""
+        gates = self.gates[start:stop]
+        if not gates:
+            return state
+        buffers = [state, np.empty_like(state)]
+        if self.workers > 1 and self.num_qubits >= self.PARALLEL_MIN_QUBITS:
+            # a few chunks per worker keeps them busy when tasks finish unevenly
+            chunk_qubits = min(self.num_qubits, (4 * self.workers - 1).bit_length())
+            with ThreadPoolExecutor(self.workers) as pool:
+                for step, instruction in enumerate(gates):
+                    _apply_gate_chunked(
+                        buffers[step % 2],
+                        instruction,
+                        buffers[(step + 1) % 2],
+                        pool,
+                        chunk_qubits,
+                    )
+            return buffers[len(gates) % 2]
+        for step, instruction in enumerate(gates):
+            _apply_gate(
+                buffers[step % 2],
+                instruction.matrix,
+                instruction.qubits,
+                instruction.controls,
+                out=buffers[(step + 1) % 2],
+            )
+        return buffers[len(gates) % 2]
+
+    def _compile_permutation(self):
+        """Bring the cached permutation form of the circuit up to date and return it
+
+        Circuits made only of basis permutations (x, cx, ccx, swap) and diagonal
+        phases (z, s, t, ...) are carried as U|i> = phases[i] |permutation[i]>,
+        which takes O(2^n) memory and O(2^n) time per gate.
+
+        Returns: (permutation, phases) arrays, or None if some gate does not fit"""
+        if self._permutation is False:
+            return None
+        new_gates = self.gates[self._permuted_gates :]
+        monomials = [_monomial(instruction.matrix) for instruction in new_gates]
+        if any(monomial is None for monomial in monomials):
+            self._permutation = False
+            return None
+        if self._permutation is None:
+            size = 2**self.num_qubits
+            dtype = np.int32 if self.num_qubits < 31 else np.int64
+            self._permutation = (
+                np.arange(size, dtype=dtype),
+                np.ones(size, dtype=self.dtype),
+            )
+        for instruction, monomial in zip(new_gates, monomials):
+            _apply_monomial(
+                *self._permutation,
+                monomial,
+                instruction.qubits,
+                instruction.controls,
+                self.num_qubits,
+            )
+        self._permuted_gates = len(self.gates)
+        return self._permutation
+
+    def fuse(self, max_qubits=2, max_diagonal_qubits=10):
+        """Rewrites the gate log so that fewer, bigger gates are applied
+
+        Each gate is merged into the last earlier gate that shares a qubit with it
+        (it commutes with everything in between) as long as the merged gate acts
+        on at most max_qubits qubits: runs of single qubit gates become one 2x2
+        matrix, neighbouring gates on a few qubits become one k-qubit block.
+        Diagonal gates (z, t, tdg, controlled phases, ...) are turned into phase
+        vectors applied elementwise, and consecutive diagonals merge into one over
+        up to max_diagonal_qubits qubits.
+
+        Example:
+            qc = LQ3K(2)
+            qc.h(0)
+            qc.t(0)
+            qc.h(0)
+            qc.t(1)
+            qc.z(1)
+            qc.fuse() # returns 3, leaving one 2x2 gate on each qubit
+
+        Returns: number of gate applications saved"""
+        fused = []
+        # index in fused of the last gate acting on each qubit
+        last = {}
+        for instruction in self.gates:
+            qubits = instruction.qubits + instruction.controls
+            previous = max((last[q] for q in qubits if q in last), default=None)
+            merged = None
+            if previous is not None:
+                merged = _merge(
+                    fused[previous], instruction, max_qubits, max_diagonal_qubits
+                )
+            if merged is not None:
+                fused[previous] = merged
+            else:
+                if _is_diagonal(instruction) and np.ndim(instruction.matrix) == 2:
+                    qubits = sorted(qubits)
+                    phases = _block((instruction,), qubits, diagonal=True)
+                    instruction = Instruction("diagonal", tuple(qubits), phases)
+                fused.append(instruction)
+                previous = len(fused) - 1
+            for qubit in qubits:
+                last[qubit] = previous
+        saved = len(self.gates) - len(fused)
+        self.gates = fused
+        self._invalidate()
+        return saved
 
     def evolve(self, initial_state):
         """Return the state vector after initial_state is passed through circuit
 
+        initial_state may also be a 2-D stack of states (one per row), which are all
+        evolved at once: with a single matrix-matrix product in unitary mode, or with
+        one batched contraction per gate in statevector mode.
+
+        Circuits made only of permutation and phase gates (x, cx, ccx, swap, z, t, tdg,
+        ...) skip both and scatter the amplitudes with their permutation instead.
+
         Example:
             qc = LQ3K(1)
             qc.x(0)
@@ -46,144 +1133,438 @@ class LQ3K:
 
             [0. 1.]
 
-        Returns: numpy.array representing state vector
+            qc.evolve(np.identity(2))
+
+            [[0. 1.]
+             [1. 0.]]
+
+        Returns: numpy.array representing state vector (a stack of them, one per row,
+            if initial_state is 2-D)
 
         Raises:
-            InvalidStateVector: When initial_state is not unit length."""
+            InvalidStateVector: When initial_state (or any of the stacked states) is
+            not unit length.
+            NonUnitaryCircuit: When the circuit measures or resets qubits."""
+        self._check_unitary()
+        states = np.asarray(initial_state)
+        self._check_memory("evolve", len(states) if states.ndim == 2 else 1)
         # if initial_state is not unit length, raise InvalidStateVector
-        if np.linalg.norm(initial_state) != 1:
+        tolerance = self.NORM_TOLERANCE
+        if states.dtype.kind in "fc":
+            # single precision input cannot be normalized that tightly
+            tolerance = max(tolerance, 16 * np.finfo(states.dtype).eps)
+        norms = np.linalg.norm(states, axis=-1)
+        if not np.allclose(norms, 1, rtol=0, atol=tolerance):
             raise self.InvalidStateVector("Initial state is not unit length")
-        return np.dot(self.unitary, initial_state)
-
-    def __neighbour_swap(self, idx_1):
-        print(f"neighbour swap {idx_1}")
-        """apply SWAP gate to the qubit at idx_1 and idx_1+1"""
-        assert idx_1 >= 0 and idx_1 < self.num_qubits - 1
-        # Define the SWAP gate as a NumPy array
-        swap_gate = np.array(
-            [[1, 0, 0, 0], [0, 0, 1, 0], [0, 1, 0, 0], [0, 0, 0, 1]], dtype=complex
-        )
-        # expand it in to 2**self.num_qubits dimensions
-        swap_gate_broadcast = np.kron(
-            np.identity(2**idx_1),
-            np.kron(swap_gate, np.identity(2 ** (self.num_qubits - idx_1 - 2))),
+        states = states.astype(self.dtype)
+        permutation = self._compile_permutation()
+        if permutation is not None:
+            permutation, phases = permutation
+            self.state_vector = np.zeros_like(states)
+            self.state_vector[..., permutation] = states * phases
+        elif self.mode == "unitary":
+            # states @ U^T evolves every row, and is U @ state for a single state
+            self.state_vector = states @ self._compile().T
+        else:
+            # gates act on the first axis, the stacked states ride along behind it;
+            # states is our own converted copy, so it can serve as a work buffer
+            state = np.ascontiguousarray(states.T)
+            self.state_vector = self._apply_gates(state).T
+        return self.state_vector
+
+    def evolve_to_file(self, path, initial_state=None, block_qubits=None):
+        """Evolve initial_state out of core, through a state vector kept in the .npy
+        file at path instead of in memory
+
+        The state is memory-mapped and the gates are applied in blocked passes (see
+        _plan_pass): each pass streams the file through memory once, 2^block_qubits
+        amplitudes at a time, and applies every following gate that fits, so a run of
+        gates on few distinct qubits costs a single pass. Only two blocks are held in
+        memory, which is what max_bytes is checked against.
+
+        Progress is checkpointed after every block to path + ".json", together with
+        the plan of the pass in progress; each block is saved to path + ".block.npy"
+        before it overwrites its part of the state. If initial_state
+        is None, the evolution picks up from an existing file instead: after a crash,
+        or to apply gates appended since it was written. It must have been written by
+        a circuit whose gates start with the ones it already applied.
+
+        Args:
+            path: .npy file holding the state, created or overwritten unless resuming
+            initial_state: state vector (may itself be a memmap) or index of a basis
+            state; None to resume
+            block_qubits: qubits per block, BLOCK_QUBITS by default
+
+        Example:
+            qc = LQ3K(34)
+            qc.h(0)
+            qc.cx(0, 33)
+            qc.evolve_to_file("state.npy", 0) # 256 GiB file, 128 MiB of memory
+
+        Returns: the final state, a numpy.memmap of path
+
+        Raises:
+            InvalidStateVector: When initial_state is not unit length.
+            CheckpointMismatch: When resuming from a file written by another circuit.
+            NonUnitaryCircuit: When the circuit measures or resets qubits."""
+        self._check_unitary()
+        num_qubits = self.num_qubits
+        progress_path = path + ".json"
+        if initial_state is None:
+            with open(progress_path) as file:
+                progress = json.load(file)
+            applied = progress["applied"]
+            if (
+                progress["num_qubits"] != num_qubits
+                or progress["dtype"] != self.dtype.str
+                or applied > len(self.gates)
+                or progress["digest"] != _gates_digest(self.gates[:applied])
+            ):
+                raise self.CheckpointMismatch(f"{path} was written by another circuit")
+            if progress.get("resident") is not None:
+                # a pass is half done, it has to be finished with the same gates
+                # and blocks
+                end = applied + progress["count"]
+                if end > len(self.gates) or progress["pass_digest"] != _gates_digest(
+                    self.gates[:end]
+                ):
+                    raise self.CheckpointMismatch(
+                        f"{path} was written by another circuit"
+                    )
+                block_qubits = progress["block_qubits"]
+        block_qubits = min(
+            num_qubits, self.BLOCK_QUBITS if block_qubits is None else block_qubits
         )
-        self.unitary = np.dot(swap_gate_broadcast, self.unitary)
+        self._check_memory("evolve_to_file", block_qubits=block_qubits)
+        block_size = 2**block_qubits
+        if initial_state is None:
+            state = np.lib.format.open_memmap(path, mode="r+")
+        else:
+            # new files read as zeros, so a basis state only needs its one amplitude
+            state = np.lib.format.open_memmap(
+                path, mode="w+", dtype=self.dtype, shape=(2**num_qubits,)
+            )
+            if isinstance(initial_state, (int, np.integer)):
+                state[initial_state] = 1
+            else:
+                if len(initial_state) != len(state):
+                    raise self.InvalidStateVector("Initial state has the wrong size")
+                norm = 0
+                for start in range(0, len(state), block_size):
+                    block = np.asarray(initial_state[start : start + block_size])
+                    norm += np.vdot(block, block).real
+                    state[start : start + block_size] = block
+                if not np.isclose(norm, 1, rtol=0, atol=self.NORM_TOLERANCE):
+                    raise self.InvalidStateVector("Initial state is not unit length")
+            progress = {
+                "num_qubits": num_qubits,
+                "dtype": self.dtype.str,
+                "applied": 0,
+                "digest": _gates_digest([]),
+                "block_qubits": block_qubits,
+                "blocks_done": 0,
+                "count": None,
+                "resident": None,
+                "pass_digest": None,
+                "pending": None,
+            }
+            state.flush()
+            _write_json(progress_path, progress)
+        tensor = state.reshape((2,) * num_qubits)
+        # a finished block is first saved here, so that a crash while it is copied
+        # into the state cannot leave it half written or apply its gates twice
+        scratch_path = path + ".block.npy"
+        while progress["applied"] < len(self.gates):
+            applied = progress["applied"]
+            if progress.get("resident") is None:
+                count, resident = _plan_pass(
+                    self.gates[applied:], num_qubits, block_qubits
+                )
+                progress.update(
+                    count=count,
+                    resident=resident,
+                    pass_digest=_gates_digest(self.gates[: applied + count]),
+                    block_qubits=block_qubits,
+                )
+                _write_json(progress_path, progress)
+            count, resident = progress["count"], progress["resident"]
+            gates = self.gates[applied : applied + count]
+            fixed = [qubit for qubit in range(num_qubits) if qubit not in resident]
+            blocks = itertools.product((0, 1), repeat=len(fixed))
+            for number, values in enumerate(blocks):
+                if number < progress["blocks_done"]:
+                    continue
+                index = [slice(None)] * num_qubits
+                for qubit, value in zip(fixed, values):
+                    index[qubit] = value
+                index = tuple(index)
+                if progress.get("pending") == number:
+                    block = np.load(scratch_path)
+                else:
+                    block = np.array(tensor[index])
+                    block = _apply_to_block(block, gates, dict(zip(fixed, values)))
+                    with open(scratch_path + ".tmp", "wb") as file:
+                        np.save(file, block)
+                    os.replace(scratch_path + ".tmp", scratch_path)
+                    progress.update(pending=number)
+                    _write_json(progress_path, progress)
+                tensor[index] = block
+                state.flush()
+                progress.update(blocks_done=number + 1, pending=None)
+                _write_json(progress_path, progress)
+            progress.update(
+                applied=applied + count,
+                digest=_gates_digest(self.gates[: applied + count]),
+                blocks_done=0,
+                count=None,
+                resident=None,
+                pass_digest=None,
+            )
+            _write_json(progress_path, progress)
+        if os.path.exists(scratch_path):
+            os.remove(scratch_path)
+        self.state_vector = state
+        return state
 
     def swap(self, idx_1, idx_2):
         """Applies SWAP gate, switching the state of the two specified qubits
         A qubit CANNOT be swapped with itself"""
-        smaller_idx = min(idx_1, idx_2)
-        bigger_idx = max(idx_1, idx_2)
-        # cumulatively apply neighbour swap (smaller_idx,smaller_idx+1), (smaller_idx+1,smaller_idx+2), ... (bigger_idx-1,bigger_idx)
-        # and then go back from bigger_idx to smaller_idx
-        for i in range(smaller_idx, bigger_idx):
-            self.__neighbour_swap(i)
-        for i in range(bigger_idx - 1, smaller_idx, -1):
-            self.__neighbour_swap(i - 1)
+        self._append("swap", GATES["swap"], idx_1, idx_2)
 
     def ccx(self, control_qubit1, control_qubit2, target_qubit):
         """Applies CCX, also known as Toffoli gate, to the specified qubits"""
-        pass
+        self._append(
+            "ccx", GATES["x"], target_qubit, controls=(control_qubit1, control_qubit2)
+        )
 
     def cx(self, control_qubit, target_qubit):
         """Applies CX, also known as controlled-NOT gate, to the specified qubits"""
-        cx_gate = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 0, 1], [0, 0, 1, 0]])
-        # conditionally make swap make sure control_qubit is smaller than target_qubit
-        if control_qubit > target_qubit:
-            self.swap(control_qubit, target_qubit)
-            control_qubit, target_qubit = target_qubit, control_qubit
-        # if target qubit and control qubit are not ajacent, make them adjacent
-        temp_target_qubit = target_qubit
-        if target_qubit != control_qubit + 1:
-            self.swap(control_qubit + 1, target_qubit)
-        cx_gate_broadcast = np.kron(
-            np.identity(2**control_qubit),
-            np.kron(cx_gate, np.identity(2 ** (self.num_qubits - control_qubit - 2))),
-        )
-        self.unitary = np.dot(cx_gate_broadcast, self.unitary)
-        # if target qubit and control qubit are not ajacent, swap back the target qubit
-        self.swap(control_qubit + 1, temp_target_qubit)
+        self._append("cx", GATES["x"], target_qubit, controls=(control_qubit,))
+
+    def cu(self, gate, control_qubits, target_qubit):
+        """Applies the single qubit gate (2x2 unitary matrix) to the target qubit,
+        controlled on all of control_qubits (a qubit index or a list of them)
+
+        Example:
+            qc = LQ3K(3)
+            qc.cu(np.array([[1, 0], [0, 1j]]), [0, 2], 1) # CCS"""
+        controls = tuple(np.atleast_1d(control_qubits).tolist())
+        self._append("cu", np.asarray(gate), target_qubit, controls=controls)
 
     def x(self, qubit_idx):
         """Applies X gate to the specified qubit"""
-        x_gate = np.array([[0, 1], [1, 0]])
-        x_gate_broadcast = np.kron(
-            np.identity(2**qubit_idx),
-            np.kron(x_gate, np.identity(2 ** (self.num_qubits - qubit_idx - 1))),
-        )
-        self.unitary = np.dot(x_gate_broadcast, self.unitary)
+        self._append("x", GATES["x"], qubit_idx)
 
     def y(self, qubit_idx):
         """Applies Y gate to the specified qubit"""
-        y_gate = np.array([[0, -1j], [1j, 0]])
-        y_gate_broadcast = np.kron(
-            np.identity(2**qubit_idx),
-            np.kron(y_gate, np.identity(2 ** (self.num_qubits - qubit_idx - 1))),
-        )
-        self.unitary = np.dot(y_gate_broadcast, self.unitary)
+        self._append("y", GATES["y"], qubit_idx)
 
     def z(self, qubit_idx):
         """Applies Z gate to the specified qubit"""
-        z_gate = np.array([[1, 0], [0, -1]])
-        z_gate_broadcast = np.kron(
-            np.identity(2**qubit_idx),
-            np.kron(z_gate, np.identity(2 ** (self.num_qubits - qubit_idx - 1))),
-        )
-        self.unitary = np.dot(z_gate_broadcast, self.unitary)
+        self._append("z", GATES["z"], qubit_idx)
 
     def h(self, qubit_idx):
         """Applies Hadamard gate to the specified qubit"""
-        h_gate = np.array([[1, 1], [1, -1]]) / np.sqrt(2)
-        h_gate_broadcast = np.kron(
-            np.identity(2**qubit_idx),
-            np.kron(h_gate, np.identity(2 ** (self.num_qubits - qubit_idx - 1))),
-        )
-        self.unitary = np.dot(h_gate_broadcast, self.unitary)
+        self._append("h", GATES["h"], qubit_idx)
 
     def t(self, qubit_idx):
         """Applies T gate to the specified qubit"""
-        t_gate = np.array([[1, 0], [0, np.exp(1j * np.pi / 4)]])
-        t_gate_broadcast = np.kron(
-            np.identity(2**qubit_idx),
-            np.kron(t_gate, np.identity(2 ** (self.num_qubits - qubit_idx - 1))),
-        )
-        self.unitary = np.dot(t_gate_broadcast, self.unitary)
+        self._append("t", GATES["t"], qubit_idx)
 
     def tdg(self, qubit_idx):
         """Applies T dag gate (complex conjugatae of T) to the specified qubit"""
-        tdg_gate = np.array([[1, 0], [0, np.exp(-1j * np.pi / 4)]])
-        tdg_gate_broadcast = np.kron(
-            np.identity(2**qubit_idx),
-            np.kron(tdg_gate, np.identity(2 ** (self.num_qubits - qubit_idx - 1))),
-        )
-        self.unitary = np.dot(tdg_gate_broadcast, self.unitary)
+        self._append("tdg", GATES["tdg"], qubit_idx)
+
+    def s(self, qubit_idx):
+        """Applies S gate (square root of Z) to the specified qubit"""
+        self._append("s", GATES["s"], qubit_idx)
+
+    def sdg(self, qubit_idx):
+        """Applies S dag gate (complex conjugate of S) to the specified qubit"""
+        self._append("sdg", GATES["sdg"], qubit_idx)
+
+    def qft(self, start, k, inverse=False):
+        """Applies the quantum Fourier transform to the k consecutive qubits start,
+        ..., start+k-1, taking qubit start as the most significant bit of the
+        register value x: |x> -> 1/sqrt(2^k) sum_y e^(2 pi i x y / 2^k) |y>, or the
+        inverse transform (e^(-2 pi i x y / 2^k)) if inverse is set
+
+        This is the H/controlled-phase circuit including its final swaps, but it is
+        applied as one FFT along the register's axis of the state, which costs
+        O(2^n k) instead of O(k^2) gate applications.
+
+        Example:
+            qc = LQ3K(3)
+            qc.qft(1, 2) # qubits 1 and 2, qubit 1 most significant"""
+        assert k >= 1 and 0 <= start and start + k <= self.num_qubits
+        name = "iqft" if inverse else "qft"
+        self._append(name, _FourierMatrix(k, inverse), *range(start, start + k))
+
+    def is_clifford(self):
+        """Returns: whether every gate of the circuit is a Clifford gate, i.e. the
+        circuit can be simulated by the stabilizer backend"""
+        return all(instruction.name in CLIFFORD_GATES for instruction in self.gates)
+
+    def _basis_index(self, initial_state):
+        """Returns the index of the computational basis state initial_state (an int
+        is taken as a basis index already), or None if it is not one"""
+        if isinstance(initial_state, (int, np.integer)):
+            return int(initial_state)
+        state = np.asarray(initial_state)
+        nonzero = np.flatnonzero(state) if state.ndim == 1 else []
+        if len(nonzero) != 1 or abs(abs(state[nonzero[0]]) - 1) > self.NORM_TOLERANCE:
+            return None
+        return int(nonzero[0])
+
+    def _tableau(self, basis_index):
+        """Returns the stabilizer tableau of the circuit applied to a basis state"""
+        tableau = StabilizerTableau(self.num_qubits)
+        for qubit in range(self.num_qubits):
+            if basis_index >> (self.num_qubits - 1 - qubit) & 1:
+                tableau.x(qubit)
+        for instruction in self.gates:
+            gate = getattr(tableau, instruction.name)
+            gate(*instruction.controls, *instruction.qubits)
+        return tableau
 
     def get_unitary(self):
-        """Returns: numpy.ndarray representing unitary matrix of circuit"""
-        return self.unitary
+        """Returns: numpy.ndarray representing unitary matrix of circuit
+
+        The unitary is compiled on the first call and cached; later calls only
+        fold in the gates added since. Circuits made only of permutation and phase
+        gates are compiled in their O(2^n) permutation form, and the dense matrix is
+        only filled in here.
+
+        Raises:
+            MemoryBudgetExceeded: When the unitary does not fit in max_bytes.
+            NonUnitaryCircuit: When the circuit measures or resets qubits."""
+        self._check_unitary()
+        self._check_memory("get_unitary")
+        permutation = self._compile_permutation()
+        if permutation is None:
+            return self._compile()
+        permutation, phases = permutation
+        unitary = np.zeros((len(permutation), len(permutation)), dtype=phases.dtype)
+        unitary[permutation, np.arange(len(permutation))] = phases
+        return unitary
 
     def print_unitary(self):
         """Prints unitary matrix of circuit"""
-        print(self.unitary)
+        print(self.get_unitary())
+
+    def probabilities(self, initial_state, qubits=None):
+        """Returns the measurement probabilities of qubits (all qubits by default)
+        after initial_state is passed through circuit
+
+        The probabilities of the other qubits are summed out on the rank-n view of
+        the state, so only one full-size probability array is ever allocated.
+        Entry i of the result is the probability of measuring the integer i, with
+        qubits[0] as its most significant bit. A 2-D stack of initial states gives
+        one row of probabilities per state.
 
-    def simulate_run(self, initial_state):
+        Raises:
+            InvalidStateVector: When initial_state is not unit length."""
+        probabilities = np.abs(self.evolve(initial_state))
+        probabilities **= 2
+        if qubits is None:
+            return probabilities
+        return _marginal(probabilities, list(qubits))
+
+    def simulate_run(
+        self, initial_state, shots=None, qubits=None, rng=None, memory=False
+    ):
         """Evolves state vector after initial_state is passed through circuit,
         and then simulates a probabilistic measurement of all qubits, returning
         result in decimal. Probabilities are determined by final state vector
 
+        With shots, the circuit is evolved once and all samples are drawn in a
+        single vectorized call. A 2-D stack of initial states is evolved as one
+        batch and gives one result per state.
+
+        If the circuit only has Clifford gates (see is_clifford) and initial_state
+        is a computational basis state, it is run on a stabilizer tableau instead,
+        which takes polynomial time and memory, so hundreds or thousands of qubits
+        can be sampled. initial_state may then also be given as the integer index
+        of the basis state, so that no 2^n vector is needed.
+
         Example:
             qc = LQ3K(2)
             qc.h(0)
             qc.cx(0, 1)
             qc.simulate_run() # returns 0 (0b00) ~50% of time, and 3 (0b11) ~50% of time
+            qc.simulate_run([1, 0, 0, 0], shots=1000, rng=8) # {'00': 483, '11': 517}
+
+        Args:
+            shots: number of measurements to sample, None for a single one
+            qubits: only measure these qubits (qubits[0] is the most significant bit
+            of the result); all qubits by default
+            rng: seed or numpy.random.Generator used for sampling
+            memory: with shots, return the outcome of every shot as an int array
+            instead of a counts dict
 
-        Returns: Integer representation of measured bits
+        Returns: Integer representation of measured bits. With shots, a dict mapping
+            measured bitstrings (Qiskit-style) to how often they were measured, or an
+            array of shots integers if memory is set. For a stack of initial states:
+            an int array, a list of dicts or a (states, shots) array respectively
         Raises:
             InvalidStateVector: When initial_state is not unit length."""
-        # if initial_state is not unit length, raise InvalidStateVector
-        if np.linalg.norm(initial_state) != 1:
-            raise self.InvalidStateVector("Initial state is not unit length")
-        final_state = self.evolve(initial_state)
-        probabilities = np.abs(final_state) ** 2
-        return np.random.choice(len(probabilities), p=probabilities)
+        rng = np.random.default_rng(rng)
+        basis_index = self._basis_index(initial_state)
+        if basis_index is not None and self.is_clifford():
+            tableau = self._tableau(basis_index)
+            bits = tableau.sample(1 if shots is None else shots, qubits, rng)
+            if shots is None:
+                return _bits_to_ints(bits)[0]
+            if memory:
+                return _bits_to_ints(bits)
+            outcomes, counts = np.unique(bits, axis=0, return_counts=True)
+            return {
+                "".join(map(str, outcome)): int(count)
+                for outcome, count in zip(outcomes.tolist(), counts)
+            }
+        if basis_index is not None and np.ndim(initial_state) == 0:
+            self._check_memory("evolve")
+            initial_state = np.zeros(2**self.num_qubits)
+            initial_state[basis_index] = 1
+        probabilities = self.probabilities(initial_state, qubits)
+        # absorb rounding errors, numpy's samplers insist on sum(p) == 1
+        probabilities /= probabilities.sum(axis=-1, keepdims=True)
+        if probabilities.ndim == 2:
+            if shots is None:
+                return _sample_rows(probabilities, 1, rng)[:, 0]
+            if memory:
+                return _sample_rows(probabilities, shots, rng)
+            return [_counts_dict(row) for row in rng.multinomial(shots, probabilities)]
+        if shots is None:
+            return int(rng.choice(len(probabilities), p=probabilities))
+        if memory:
+            return rng.choice(len(probabilities), size=shots, p=probabilities)
+        return _counts_dict(rng.multinomial(shots, probabilities))
+
+
+def run_sim(qc, num_shots):
+    """Drop-in for the run_sim helpers of the other projects: runs the Qiskit
+    QuantumCircuit qc on LQ3K instead of Aer
+
+    Returns: counts dict in Qiskit's format (one space-separated group of bits per
+        classical register, the last register first)
+
+    Raises:
+        ValueError: When qc has no classical bits, so there is nothing to count
+        LQ3K.UnsupportedInstruction: See LQ3K.from_qiskit"""
+    if not qc.num_clbits:
+        raise ValueError("No counts for a circuit without classical bits")
+    counts = LQ3K.from_qiskit(qc, mode="statevector").run(num_shots)
+    if len(qc.cregs) < 2:
+        return counts
+    width = qc.num_clbits
+    registers = [
+        [qc.find_bit(clbit).index for clbit in register] for register in qc.cregs
+    ]
+    return {
+        " ".join(
+            "".join(key[width - 1 - index] for index in reversed(register))
+            for register in reversed(registers)
+        ): count
+        for key, count in counts.items()
+    }
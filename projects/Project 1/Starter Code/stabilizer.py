@@ -0,0 +1,210 @@
+import numpy as np
+
+
+# number of set bits in every possible byte
+_POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.int64)
+
+
+def _phase_exponent(x1, z1, x2, z2):
+    """Returns sum_j g(x1_j, z1_j, x2_j, z2_j) of Aaronson & Gottesman over packed
+    rows, i.e. the power of i picked up when multiplying Pauli (x1, z1) into each
+    Pauli (x2, z2). x2/z2 may hold many rows, x1/z1 broadcast against them"""
+    x_only = x1 & ~z1
+    y_only = x1 & z1
+    z_only = ~x1 & z1
+    plus = (y_only & z2 & ~x2) | (x_only & z2 & x2) | (z_only & x2 & ~z2)
+    minus = (y_only & x2 & ~z2) | (x_only & z2 & ~x2) | (z_only & x2 & z2)
+    return _POPCOUNT[plus].sum(axis=-1) - _POPCOUNT[minus].sum(axis=-1)
+
+
+def _rowsum(x, z, r, rows, source):
+    """Multiply row source of the packed Paulis (x, z, r) into each of rows, which
+    must not contain source (rowsum of Aaronson & Gottesman)"""
+    exponent = 2 * r[rows].astype(np.int64) + 2 * int(r[source])
+    exponent += _phase_exponent(x[source], z[source], x[rows], z[rows])
+    r[rows] = exponent % 4 == 2
+    x[rows] ^= x[source]
+    z[rows] ^= z[source]
+
+
+def _column(part, qubit):
+    """Bit qubit of every row of the packed array part as a 0/1 uint8 array"""
+    return (part[:, qubit >> 3] >> (qubit & 7)) & 1
+
+
+def _xor_column(part, qubit, bits):
+    """Flip bit qubit of the rows of the packed array part where bits is 1"""
+    part[:, qubit >> 3] ^= bits << (qubit & 7)
+
+
+class StabilizerTableau:
+    """Aaronson-Gottesman tableau of an n qubit stabilizer state, starting in |0...0>
+
+    Rows 0..n-1 are the destabilizers, rows n..2n-1 the stabilizers. The X and Z
+    parts of every row are bit-packed (qubit q is bit q % 8 of byte q // 8), so
+    Clifford gates cost O(n^2 / 8) bit operations and memory stays O(n^2 / 8),
+    which is fine for thousands of qubits.
+
+    Args:
+        num_qubits: number of qubits in the state
+
+        Example:
+            tableau = StabilizerTableau(2)
+            tableau.h(0)
+            tableau.cx(0, 1)
+            tableau.sample(4, rng=1) # rows of [0, 0] or [1, 1]
+    """
+
+    def __init__(self, num_qubits):
+        self.num_qubits = num_qubits
+        num_bytes = (num_qubits + 7) // 8
+        identity = np.identity(num_qubits, dtype=np.uint8)
+        identity = np.packbits(identity, axis=1, bitorder="little")
+        self.xs = np.zeros((2 * num_qubits, num_bytes), dtype=np.uint8)
+        self.zs = np.zeros((2 * num_qubits, num_bytes), dtype=np.uint8)
+        self.xs[:num_qubits] = identity
+        self.zs[num_qubits:] = identity
+        # sign bits, 1 means a -1 phase
+        self.signs = np.zeros(2 * num_qubits, dtype=np.uint8)
+
+    def copy(self):
+        tableau = StabilizerTableau.__new__(StabilizerTableau)
+        tableau.num_qubits = self.num_qubits
+        tableau.xs, tableau.zs = self.xs.copy(), self.zs.copy()
+        tableau.signs = self.signs.copy()
+        return tableau
+
+    def h(self, qubit):
+        x, z = _column(self.xs, qubit), _column(self.zs, qubit)
+        self.signs ^= x & z
+        _xor_column(self.xs, qubit, x ^ z)
+        _xor_column(self.zs, qubit, x ^ z)
+
+    def s(self, qubit):
+        x, z = _column(self.xs, qubit), _column(self.zs, qubit)
+        self.signs ^= x & z
+        _xor_column(self.zs, qubit, x)
+
+    def sdg(self, qubit):
+        x, z = _column(self.xs, qubit), _column(self.zs, qubit)
+        self.signs ^= x & (z ^ 1)
+        _xor_column(self.zs, qubit, x)
+
+    def x(self, qubit):
+        self.signs ^= _column(self.zs, qubit)
+
+    def y(self, qubit):
+        self.signs ^= _column(self.xs, qubit) ^ _column(self.zs, qubit)
+
+    def z(self, qubit):
+        self.signs ^= _column(self.xs, qubit)
+
+    def cx(self, control, target):
+        x_c, z_c = _column(self.xs, control), _column(self.zs, control)
+        x_t, z_t = _column(self.xs, target), _column(self.zs, target)
+        self.signs ^= x_c & z_t & (x_t ^ z_c ^ 1)
+        _xor_column(self.xs, target, x_c)
+        _xor_column(self.zs, control, z_t)
+
+    def swap(self, qubit_1, qubit_2):
+        for part in (self.xs, self.zs):
+            diff = _column(part, qubit_1) ^ _column(part, qubit_2)
+            _xor_column(part, qubit_1, diff)
+            _xor_column(part, qubit_2, diff)
+
+    def measure(self, qubit, rng=None):
+        """Measures qubit in the computational basis, collapsing the state
+
+        Returns: the outcome, 0 or 1"""
+        n = self.num_qubits
+        x_column = _column(self.xs, qubit)
+        anticommuting = np.flatnonzero(x_column[n:])
+        if len(anticommuting):
+            # random outcome: the first anticommuting stabilizer p is replaced by
+            # +-Z_qubit after being multiplied into every other anticommuting row
+            p = anticommuting[0] + n
+            rows = np.flatnonzero(x_column)
+            _rowsum(self.xs, self.zs, self.signs, rows[rows != p], p)
+            for part in (self.xs, self.zs, self.signs):
+                part[p - n] = part[p]
+            self.xs[p] = 0
+            self.zs[p] = 0
+            _xor_column(self.zs[p : p + 1], qubit, np.ones(1, dtype=np.uint8))
+            self.signs[p] = np.random.default_rng(rng).integers(2)
+            return int(self.signs[p])
+        # deterministic outcome: +-Z_qubit is the product of the stabilizers whose
+        # destabilizers anticommute with it, and its sign is the outcome
+        x = np.zeros_like(self.xs[0])
+        z = np.zeros_like(self.zs[0])
+        r = 0
+        for row in np.flatnonzero(x_column[:n]) + n:
+            exponent = 2 * r + 2 * int(self.signs[row])
+            exponent += int(_phase_exponent(self.xs[row], self.zs[row], x, z))
+            r = int(exponent % 4 == 2)
+            x ^= self.xs[row]
+            z ^= self.zs[row]
+        return r
+
+    def reset(self, qubit, rng=None):
+        """Measures qubit and flips it back to |0> if needed"""
+        if self.measure(qubit, rng):
+            self.x(qubit)
+
+    def sample(self, shots, qubits=None, rng=None):
+        """Samples shots computational basis measurements of qubits (all qubits by
+        default) without collapsing the state
+
+        The outcomes of a stabilizer state are uniform over an affine subspace: the
+        stabilizers are row reduced until all X parts are eliminated but k, the
+        remaining +-Z-type stabilizers give the linear constraints, and samples are
+        a particular solution plus random combinations of the k null space vectors.
+
+        Returns: (shots, len(qubits)) uint8 array of measured bits"""
+        rng = np.random.default_rng(rng)
+        n = self.num_qubits
+        qubits = list(range(n)) if qubits is None else list(qubits)
+        x, z, r = self.xs[n:].copy(), self.zs[n:].copy(), self.signs[n:].copy()
+        # eliminate the X parts: afterwards only rows[:rank] have one
+        rank = 0
+        for qubit in range(n):
+            column = _column(x, qubit)
+            candidates = np.flatnonzero(column[rank:]) + rank
+            if not len(candidates):
+                continue
+            pivot = candidates[0]
+            for part in (x, z, r, column):
+                part[[rank, pivot]] = part[[pivot, rank]]
+            others = np.flatnonzero(column)
+            _rowsum(x, z, r, others[others != rank], rank)
+            rank += 1
+        # the Z-type stabilizers (-1)^r Z^v say v . outcome = r (mod 2); bring the
+        # system to reduced row echelon form
+        system = np.unpackbits(z[rank:], axis=1, count=n, bitorder="little")
+        rhs = r[rank:].copy()
+        pivots = []
+        for qubit in range(n):
+            if len(pivots) == len(system):
+                break
+            row = len(pivots)
+            candidates = np.flatnonzero(system[row:, qubit]) + row
+            if not len(candidates):
+                continue
+            for part in (system, rhs):
+                part[[row, candidates[0]]] = part[[candidates[0], row]]
+            others = np.flatnonzero(system[:, qubit])
+            others = others[others != row]
+            system[others] ^= system[row]
+            rhs[others] ^= rhs[row]
+            pivots.append(qubit)
+        free = [qubit for qubit in range(n) if qubit not in set(pivots)]
+        particular = np.zeros(n, dtype=np.uint8)
+        particular[pivots] = rhs
+        # one null space vector per free qubit: the free qubit set, and every pivot
+        # qubit whose equation contains it
+        null_space = np.zeros((len(free), n), dtype=np.float32)
+        null_space[np.arange(len(free)), free] = 1
+        null_space[:, pivots] = system[:, free].T
+        coefficients = rng.integers(0, 2, (shots, len(free))).astype(np.float32)
+        # float products are exact here, sums stay far below 2^24
+        bits = (coefficients @ null_space[:, qubits]).astype(np.int64) % 2
+        return bits.astype(np.uint8) ^ particular[qubits]
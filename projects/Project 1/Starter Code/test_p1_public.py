@@ -1,9 +1,14 @@
+import os
+import tempfile
 import unittest
+from unittest import mock
 import numpy as np
-from qiskit import QuantumCircuit
+from qiskit import QuantumCircuit, QuantumRegister, ClassicalRegister
+from qiskit.circuit.library import MCXGate
 from qiskit.quantum_info import Statevector, Operator
 from qiskit_aer import AerSimulator
-from p1 import LQ3K
+import p1
+from p1 import LQ3K, run_sim
 
 test_gate = 2
 
@@ -45,6 +50,321 @@ class TestP1Public(unittest.TestCase):
             qc_state = Statevector(qc).data
             self.assertTrue(np.array_equal(lc_state, qc_state))
 
+    def test_statevector_mode(self):
+        init_state: np.ndarray = np.array([0] * 2**3)
+        init_state[5] = 1
+        qc = QuantumCircuit(3)
+        qc.initialize(init_state, qc.qubits)
+        lc = LQ3K(3, mode="statevector")
+        # LQ3K qubit i is qiskit qubit 2 - i
+        qc.h(2)
+        qc.t(1)
+        qc.cx(2, 0)
+        qc.y(0)
+        lc.h(0)
+        lc.t(1)
+        lc.cx(0, 2)
+        lc.y(2)
+        self.assertTrue(np.allclose(lc.evolve(init_state), Statevector(qc).data))
+        dense = LQ3K(3)
+        dense.h(0)
+        dense.t(1)
+        dense.cx(0, 2)
+        dense.y(2)
+        self.assertTrue(np.allclose(lc.get_unitary(), dense.get_unitary()))
+
+    def test_incremental_compile(self):
+        lc = LQ3K(2)
+        lc.h(0)
+        lc.get_unitary()
+        lc.cx(0, 1)
+        fresh = LQ3K(2)
+        fresh.h(0)
+        fresh.cx(0, 1)
+        self.assertTrue(np.allclose(lc.get_unitary(), fresh.get_unitary()))
+        self.assertTrue(np.allclose(lc.evolve([1, 0, 0, 0]), [1, 0, 0, 1] / np.sqrt(2)))
+
+    def test_long_range_gates(self):
+        # LQ3K qubit i is qiskit qubit 3 - i
+        qc = QuantumCircuit(4)
+        qc.cx(0, 3)
+        qc.ccx(3, 1, 2)
+        qc.swap(0, 2)
+        qc.cs(1, 0)
+        lc = LQ3K(4)
+        lc.cx(3, 0)
+        lc.ccx(0, 2, 1)
+        lc.swap(3, 1)
+        lc.cu(np.array([[1, 0], [0, 1j]]), 2, 3)
+        self.assertTrue(np.allclose(lc.get_unitary(), Operator(qc).data))
+
+    def test_shots(self):
+        lc = LQ3K(3)
+        lc.h(0)
+        lc.cx(0, 1)
+        lc.x(2)
+        init_state = [1, 0, 0, 0, 0, 0, 0, 0]
+        counts = lc.simulate_run(init_state, shots=1000, rng=1)
+        self.assertEqual(set(counts), {"001", "111"})
+        self.assertEqual(sum(counts.values()), 1000)
+        self.assertEqual(counts, lc.simulate_run(init_state, shots=1000, rng=1))
+        marginal = lc.simulate_run(init_state, shots=100, qubits=[2, 0], rng=1)
+        self.assertEqual(set(marginal), {"10", "11"})
+        memory = lc.simulate_run(init_state, shots=100, rng=1, memory=True)
+        self.assertEqual(memory.shape, (100,))
+        self.assertTrue(set(memory.tolist()) <= {1, 7})
+
+    def test_batched_evolve(self):
+        operator_circuit = QuantumCircuit(3)
+        operator_circuit.h(2)
+        operator_circuit.cx(2, 0)
+        operator_circuit.t(1)
+        circuitOp = Operator.from_circuit(operator_circuit)
+        init_states = np.identity(2**3)
+        for mode in LQ3K.MODES:
+            lc = LQ3K(3, mode=mode)
+            lc.h(0)
+            lc.cx(0, 2)
+            lc.t(1)
+            # row i is the image of basis state i, i.e. column i of the unitary
+            self.assertTrue(np.allclose(lc.evolve(init_states), circuitOp.data.T))
+            with self.assertRaises(LQ3K.InvalidStateVector):
+                lc.evolve(2 * init_states)
+
+    def test_fuse(self):
+        lc = LQ3K(3)
+        lc.h(0)
+        lc.t(0)
+        lc.h(0)
+        lc.cx(0, 1)
+        lc.t(2)
+        lc.z(2)
+        lc.tdg(1)
+        lc.ccx(0, 1, 2)
+        unitary = lc.get_unitary().copy()
+        self.assertEqual(lc.fuse(), 5)
+        self.assertEqual(len(lc.gates), 3)
+        self.assertTrue(np.allclose(lc.get_unitary(), unitary))
+
+    def test_clifford_backend(self):
+        lc = LQ3K(4)
+        lc.h(0)
+        lc.s(0)
+        lc.cx(0, 3)
+        lc.h(2)
+        lc.swap(2, 1)
+        lc.y(3)
+        lc.sdg(1)
+        lc.h(1)
+        self.assertTrue(lc.is_clifford())
+        init_state = np.array([0] * 2**4)
+        init_state[6] = 1
+        probabilities = lc.probabilities(init_state)
+        counts = lc.simulate_run(init_state, shots=2000, rng=3)
+        self.assertEqual(
+            {int(outcome, 2) for outcome in counts},
+            set(np.flatnonzero(probabilities > 1e-9)),
+        )
+        lc.t(0)
+        self.assertFalse(lc.is_clifford())
+        # far beyond what a 2^n state vector could hold
+        ghz = LQ3K(300)
+        ghz.h(0)
+        for qubit in range(299):
+            ghz.cx(qubit, qubit + 1)
+        counts = ghz.simulate_run(0, shots=100, qubits=[0, 150, 299], rng=3)
+        self.assertEqual(set(counts), {"000", "111"})
+
+    def test_permutation_circuit(self):
+        # LQ3K qubit i is qiskit qubit 3 - i
+        qc = QuantumCircuit(4)
+        qc.x(3)
+        qc.ccx(3, 2, 0)
+        qc.t(0)
+        qc.swap(1, 3)
+        qc.cx(0, 2)
+        qc.y(1)
+        qc.tdg(2)
+        lc = LQ3K(4)
+        lc.x(0)
+        lc.ccx(0, 1, 3)
+        lc.t(3)
+        lc.swap(2, 0)
+        lc.cx(3, 1)
+        lc.y(2)
+        lc.tdg(1)
+        self.assertTrue(np.allclose(lc.get_unitary(), Operator(qc).data))
+        self.assertIsNotNone(lc._compile_permutation())
+        init_state = np.full(2**4, 0.25)
+        self.assertTrue(np.allclose(lc.evolve(init_state), Operator(qc).data @ init_state))
+
+    def test_dtype_and_budget(self):
+        for mode in LQ3K.MODES:
+            lc = LQ3K(3, mode=mode, dtype=np.complex64)
+            lc.h(0)
+            lc.y(1)
+            lc.cx(0, 2)
+            self.assertEqual(lc.evolve([1, 0, 0, 0, 0, 0, 0, 0]).dtype, np.complex64)
+            self.assertEqual(lc.get_unitary().dtype, np.complex64)
+        lc = LQ3K(3, mode="statevector", max_bytes=1000)
+        lc.h(0)
+        self.assertEqual(lc.estimate_memory(), 3 * 2**3 * 16)
+        lc.evolve([1, 0, 0, 0, 0, 0, 0, 0])
+        with self.assertRaises(LQ3K.MemoryBudgetExceeded):
+            lc.get_unitary()
+
+    def test_parallel_statevector(self):
+        circuits = [LQ3K(14, mode="statevector", workers=w) for w in (1, 3)]
+        for lc in circuits:
+            lc.h(0)
+            lc.cx(0, 13)
+            lc.ccx(13, 1, 0)
+            lc.t(2)
+            lc.swap(1, 12)
+            lc.cu(np.array([[0, 1], [1, 0]]), [0, 1, 2], 5)
+        init_states = np.identity(2**14)[[0, 1, 7, 2**13 + 2**12 + 2**11]]
+        serial, parallel = (lc.evolve(init_states) for lc in circuits)
+        self.assertTrue(np.allclose(serial, parallel))
+
+    def test_evolve_to_file(self):
+        lc = LQ3K(6, mode="statevector")
+        lc.h(0)
+        lc.cx(0, 5)
+        lc.ccx(5, 1, 4)
+        lc.t(0)
+        lc.cu(np.array([[1, 0], [0, 1j]]), [2], 0)
+        lc.swap(1, 3)
+        expected = lc.evolve(np.identity(2**6)[9])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "state.npy")
+            # only the first three gates, then resume with the rest
+            half = LQ3K(6)
+            half.gates = lc.gates[:3]
+            half.evolve_to_file(path, 9, block_qubits=2)
+            state = lc.evolve_to_file(path, block_qubits=2)
+            self.assertTrue(np.allclose(state, expected))
+            other = LQ3K(6)
+            other.x(0)
+            with self.assertRaises(LQ3K.CheckpointMismatch):
+                other.evolve_to_file(path)
+
+    def test_evolve_to_file_crash(self):
+        # 4 blocks of 2 qubits; crash once 2 of them are done, or once the third is
+        # saved but not yet copied into the state, then resume with a gate appended
+        for crash in ("blocks_done", "pending"):
+            lc = LQ3K(4)
+            lc.h(3)
+            write_json = p1._write_json
+
+            def crashing_write(path, data):
+                write_json(path, data)
+                if data[crash] == 2:
+                    raise KeyboardInterrupt
+
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "state.npy")
+                with mock.patch.object(p1, "_write_json", crashing_write):
+                    with self.assertRaises(KeyboardInterrupt):
+                        lc.evolve_to_file(path, 0, block_qubits=2)
+                lc.h(2)
+                state = lc.evolve_to_file(path)
+                expected = np.zeros(16)
+                expected[:4] = 0.5
+                self.assertTrue(np.allclose(state, expected))
+
+    def test_from_qiskit(self):
+        qc = QuantumCircuit(4)
+        qc.h(0)
+        qc.mcx([0, 1, 2], 3)
+        qc.cp(0.3, 3, 1)
+        qc.append(MCXGate(2, ctrl_state="01"), [2, 0, 1])
+        qc.rzz(0.4, 0, 3)
+        qc.cu(0.3, 0.2, 0.1, 0.7, 0, 1)
+        qc.cu(0.5, 0.4, 0.3, 0.2, 2, 3, ctrl_state=0)
+        sub = QuantumCircuit(2)
+        sub.h(0)
+        sub.cy(0, 1)
+        qc.append(sub.to_instruction(), [3, 1])
+        qc.global_phase = 0.7
+        self.assertTrue(np.allclose(LQ3K.from_qiskit(qc).get_unitary(), Operator(qc).data))
+        qc = QuantumCircuit(3)
+        qc.initialize("1+", [0, 2])
+        qc.cx(2, 1)
+        lc = LQ3K.from_qiskit(qc)
+        self.assertTrue(np.allclose(lc.evolve(lc.initial_state), Statevector(qc).data))
+        qc = QuantumCircuit(QuantumRegister(3), ClassicalRegister(2), ClassicalRegister(1))
+        qc.h(0)
+        qc.cx(0, 1)
+        qc.x(2)
+        qc.measure([0, 1, 2], [1, 0, 2])
+        self.assertEqual(set(run_sim(qc, 100)), {"1 00", "1 11"})
+
+    def test_qft(self):
+        for mode in LQ3K.MODES:
+            native = LQ3K(5, mode=mode)
+            native.h(0)
+            native.qft(1, 3)
+            gates = LQ3K(5, mode=mode)
+            gates.h(0)
+            # H and controlled phases on qubits 1-3, then swap 1 and 3
+            for target in range(1, 4):
+                gates.h(target)
+                for control in range(target + 1, 4):
+                    phase = np.exp(1j * np.pi / 2 ** (control - target))
+                    gates.cu(np.diag([1, phase]), [control], target)
+            gates.swap(1, 3)
+            self.assertTrue(np.allclose(native.get_unitary(), gates.get_unitary()))
+            init_state = np.full(2**5, 2**-2.5)
+            self.assertTrue(
+                np.allclose(native.evolve(init_state), gates.evolve(init_state))
+            )
+            native.qft(1, 3, inverse=True)
+            native.h(0)
+            self.assertTrue(np.allclose(native.get_unitary(), np.identity(2**5)))
+            # small QFTs fuse into blocks, bigger ones stay FFTs
+            for max_qubits in (2, 3):
+                fused = LQ3K(3, mode=mode)
+                fused.h(0)
+                fused.qft(0, 2)
+                fused.qft(0, 3, inverse=True)
+                expected = fused.get_unitary()
+                fused.fuse(max_qubits=max_qubits)
+                self.assertTrue(np.allclose(fused.get_unitary(), expected))
+
+    def test_mid_circuit_measurement(self):
+        lc = LQ3K(2, num_clbits=3)
+        lc.h(0)
+        lc.cx(0, 1)
+        lc.measure(0, 0)
+        lc.x(1)
+        lc.measure(1, 1)
+        lc.h(0)
+        lc.reset(0)
+        lc.measure(0, 2)
+        with self.assertRaises(LQ3K.NonUnitaryCircuit):
+            lc.evolve([1, 0, 0, 0])
+        counts = lc.run(1000, rng=2)
+        self.assertEqual(set(counts), {"010", "001"})
+        self.assertEqual(sum(counts.values()), 1000)
+        # the branches of every reset merge back, so this stays cheap
+        lc = LQ3K(3, num_clbits=1)
+        for _ in range(200):
+            lc.h(0)
+            lc.cx(0, 2)
+            lc.reset(0)
+            lc.reset(2)
+        lc.x(1)
+        lc.measure(1, 0)
+        self.assertEqual(lc.run(10000, rng=2), {"1": 10000})
+        # the last measurement into a clbit wins, even when an earlier one is
+        # terminal and the later one is not
+        qc = QuantumCircuit(2, 1)
+        qc.x(1)
+        qc.measure(0, 0)
+        qc.measure(1, 0)
+        qc.x(1)
+        self.assertEqual(run_sim(qc, 1000), {"1": 1000})
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,10 @@
 from qiskit import *
 import numpy as np
 import math
-from typing import List, Tuple
+from qiskit.circuit.library import DiagonalGate
+from typing import Dict, List, Tuple
 
-import grover
+import grover, oracle
 
 
 def qft(n: int) -> QuantumCircuit:
@@ -22,4 +23,203 @@ def quantum_counter(cnf: List[List[int]], num_vars: int, precision: int) -> Quan
         cnf: Array of clauses of literals
         num_vars: number of variables using in quantum counting algorithm
         precision: number of counting bits using in quantum counting"""
-    pass
\ No newline at end of file
+    pass
+
+def count_distribution(num_solutions: int, num_vars: int, precision: int) -> np.ndarray:
+    """Returns the probabilities of the 2^precision outcomes of quantum counting,
+    without simulating it
+    The Grover operator acts on the span of the solution and non-solution states
+    as a rotation by 2 theta, sin(theta)^2 = num_solutions / 2^num_vars. The
+    uniform input state is an equal superposition of its two eigenvectors, with
+    phases +-theta / pi (in turns), so the outcome distribution is the average of
+    the phase estimation distributions of those two phases.
+    Args:
+        num_solutions: Number of solutions of the CNF
+        num_vars: number of variables using in quantum counting algorithm
+        precision: number of counting bits using in quantum counting"""
+    theta = math.asin(math.sqrt(num_solutions / 2**num_vars))
+    powers = np.arange(2**precision)
+    probabilities = np.zeros(2**precision)
+    for phase in (theta / math.pi, -theta / math.pi):
+        # amplitude of outcome k: sum_j e^(2 pi i j (phase - k / 2^t)) / 2^t
+        amplitudes = np.fft.fft(np.exp(2j * math.pi * powers * phase)) / 2**precision
+        probabilities += np.abs(amplitudes) ** 2 / 2
+    return probabilities
+
+
+def estimate_solutions(result, num_vars: int, precision: int) -> float:
+    """Returns the number of solutions a quantum counting outcome stands for,
+    2^num_vars sin(pi k / 2^precision)^2
+    Args:
+        result: Measured counting bits, as a bit string or the int k
+        num_vars: number of variables using in quantum counting algorithm
+        precision: number of counting bits using in quantum counting"""
+    k = int(result.replace(" ", ""), 2) if isinstance(result, str) else result
+    return 2**num_vars * math.sin(math.pi * k / 2**precision) ** 2
+
+
+def emulate_counter(
+    cnf: List[List[int]], num_vars: int, precision: int, num_shots: int, rng=None
+) -> Dict[str, int]:
+    """Returns counts of the counting bits of quantum_counter(cnf, num_vars,
+    precision) for num_shots shots, as a simulator would (bit strings of k, most
+    significant bit first), sampled from count_distribution after counting the
+    solutions classically with oracle.truth_table
+    The cost is 2^num_vars for the count and 2^precision for the distribution,
+    instead of simulating num_vars + precision (+ ancilla) qubits; it also gives
+    the reference distribution to check the real circuit against
+    Args:
+        cnf: Array of clauses of literals
+        num_vars: number of variables using in quantum counting algorithm
+        precision: number of counting bits using in quantum counting
+        num_shots: number of samples
+        rng: seed or numpy Generator for the samples"""
+    num_solutions = int(oracle.truth_table(cnf, num_vars).sum())
+    probabilities = count_distribution(num_solutions, num_vars, precision)
+    samples = np.random.default_rng(rng).multinomial(num_shots, probabilities / probabilities.sum())
+    return {
+        format(k, "0%db" % precision): int(count) for k, count in enumerate(samples) if count
+    }
+
+
+def emulate_count(
+    cnf: List[List[int]], num_vars: int, precision: int, num_shots: int = 1000, rng=None
+) -> Tuple[float, float]:
+    """Runs the counting stage on emulate_counter and reports it like the driver
+    (COUNT - lines, see correct_1.txt)
+    Returns: (estimated number of solutions, estimated number of Grover iterations)"""
+    print("COUNT - Counting solutions for %d variables..." % num_vars)
+    counts = emulate_counter(cnf, num_vars, precision, num_shots, rng)
+    solutions = estimate_solutions(max(counts, key=counts.get), num_vars, precision)
+    print("COUNT - Estimated number of solutions: %.2f" % solutions)
+    if solutions < 0.5:
+        print("COUNT - No solutions expected, exiting")
+        return solutions, 0.0
+    iterations = math.pi / 4 * math.sqrt(2**num_vars / solutions)
+    print("COUNT - Estimated number of Grover Iterations: %.2f" % iterations)
+    return solutions, iterations
+
+
+def _controlled_grover_iteration(cnf: List[List[int]], num_vars: int) -> QuantumCircuit:
+    """Returns the Grover iteration (phase oracle, then the diffuser 2|s><s| - I)
+    controlled by qubit 0, acting on qubits 1..num_vars (plus oracle ancillas)
+    Up to MAX_TABLE_VARS variables the controlled oracle is one diagonal gate over
+    the control and the inputs; beyond, the bitflip oracle computes f into an
+    output qubit, which gets a CZ from the control, and is run again to uncompute"""
+    if num_vars <= oracle.MAX_TABLE_VARS:
+        qc = QuantumCircuit(1 + num_vars)
+        # diagonal index bit 0 is the control: phases only where it is 1
+        phases = np.ones(2 ** (num_vars + 1))
+        phases[1::2] = np.where(oracle.truth_table(cnf, num_vars), -1.0, 1.0)
+        qc.append(DiagonalGate(phases), range(1 + num_vars))
+    else:
+        bf_oracle = oracle.get_bitflip_oracle(cnf, num_vars)
+        qc = QuantumCircuit(1 + bf_oracle.num_qubits)
+        qc.compose(bf_oracle, range(1, 1 + bf_oracle.num_qubits), inplace=True)
+        qc.cz(0, 1 + num_vars)
+        qc.compose(bf_oracle, range(1, 1 + bf_oracle.num_qubits), inplace=True)
+    inputs = list(range(1, 1 + num_vars))
+    # 2|s><s| - I = -H X (I - 2|1...1><1...1|) X H, the -1 only matters controlled
+    qc.h(inputs)
+    qc.x(inputs)
+    qc.mcp(math.pi, inputs[:-1] + [0], inputs[-1])
+    qc.x(inputs)
+    qc.h(inputs)
+    qc.z(0)
+    return qc
+
+
+def iterative_quantum_counter(cnf: List[List[int]], num_vars: int, precision: int) -> QuantumCircuit:
+    """Returns the quantum counting circuit with iterative phase estimation: a
+    single control qubit is reused for every counting bit, so the width is
+    1 + num_vars (+ oracle ancillas above MAX_TABLE_VARS variables) whatever the
+    precision
+    Round b controls G^(2^(precision-1-b)), applies the phase correction of the
+    bits measured so far (fed forward with if_test), and measures bit b of k into
+    clbit b before resetting the control. The counts have the same distribution
+    as the counting bits of quantum_counter (see count_distribution)
+    Args:
+        cnf: Array of clauses of literals
+        num_vars: number of variables using in quantum counting algorithm
+        precision: number of counting bits using in quantum counting"""
+    step = _controlled_grover_iteration(cnf, num_vars)
+    qubits = QuantumRegister(step.num_qubits)
+    result = ClassicalRegister(precision, "k")
+    qc = QuantumCircuit(qubits, result)
+    control = qubits[0]
+    qc.h(qubits[1 : 1 + num_vars])
+    for bit in range(precision):
+        qc.h(control)
+        for _ in range(2 ** (precision - 1 - bit)):
+            qc.compose(step, qubits, inplace=True)
+        # remove the phase of the less significant bits, already measured
+        for lower in range(bit):
+            with qc.if_test((result[lower], 1)):
+                qc.p(-math.pi / 2 ** (bit - lower), control)
+        qc.h(control)
+        qc.measure(control, result[bit])
+        qc.reset(control)
+    return qc
+
+
+def grover_iterations(num_solutions: float, num_vars: int) -> int:
+    """Returns the number of Grover iterations that best amplifies num_solutions
+    solutions out of 2^num_vars, floor(pi / (4 theta)), 0 when there are none"""
+    if num_solutions <= 0:
+        return 0
+    theta = math.asin(math.sqrt(min(num_solutions / 2**num_vars, 1)))
+    return int(math.pi / (4 * theta))
+
+
+def _run_on_aer(qc: QuantumCircuit, num_shots: int) -> Dict[str, int]:
+    from qiskit_aer import AerSimulator
+
+    sim = AerSimulator()
+    return sim.run(transpile(qc, sim), shots=num_shots).result().get_counts()
+
+
+def iterative_count(
+    cnf: List[List[int]],
+    num_vars: int,
+    max_precision: int,
+    num_shots: int = 100,
+    tolerance: float = 0.1,
+    run=None,
+) -> Tuple[float, int, int]:
+    """Counts solutions with iterative_quantum_counter, adding counting bits until
+    the Grover iteration choice is settled
+    With precision t the most frequent outcome gives theta to within pi / 2^t
+    (with probability at least 8 / pi^2). Counting stops once the success
+    probability sin((2r + 1) theta)^2 of the iteration count r chosen from the
+    estimate is within tolerance of its value at the estimate over that whole
+    interval, or at max_precision
+    Args:
+        cnf: Array of clauses of literals
+        num_vars: number of variables using in quantum counting algorithm
+        max_precision: most counting bits to use
+        num_shots: shots per precision
+        tolerance: allowed loss of Grover success probability
+        run: function (circuit, num_shots) -> counts dict, AerSimulator by default
+    Returns: (estimated number of solutions, Grover iterations, precision used)"""
+    if max_precision < 1:
+        raise ValueError("max_precision must be at least 1, got %d" % max_precision)
+    run = _run_on_aer if run is None else run
+    for precision in range(1, max_precision + 1):
+        counts = run(iterative_quantum_counter(cnf, num_vars, precision), num_shots)
+        # k and 2^t - k stand for the same theta (the two eigenphases)
+        folded = {}
+        for result, count in counts.items():
+            k = int(result.replace(" ", ""), 2)
+            k = min(k, 2**precision - k)
+            folded[k] = folded.get(k, 0) + count
+        k = max(folded, key=folded.get)
+        solutions = estimate_solutions(k, num_vars, precision)
+        iterations = grover_iterations(solutions, num_vars)
+        theta = math.pi * k / 2**precision
+        spread = math.pi / 2**precision
+        if theta - spread > 0:
+            thetas = np.linspace(theta - spread, min(theta + spread, math.pi / 2), 33)
+            success = np.sin((2 * iterations + 1) * thetas) ** 2
+            if success.min() >= math.sin((2 * iterations + 1) * theta) ** 2 - tolerance:
+                break
+    return solutions, iterations, precision
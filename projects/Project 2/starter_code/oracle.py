@@ -1,9 +1,14 @@
 from qiskit import QuantumCircuit
 
 from qiskit.circuit import QuantumRegister, ClassicalRegister, AncillaRegister
-from qiskit.circuit.library.standard_gates import SXGate, MCXGate
+from qiskit.circuit import ControlledGate
+from qiskit.circuit.library.standard_gates import SXGate, MCXGate, XGate
+from qiskit.circuit.library import DiagonalGate
+from qiskit.quantum_info import Statevector
 
-from typing import List
+from typing import List, Optional
+
+import numpy as np
 
 # RESTRICTIONS ON CNF (you do not need to verify these):
 # every variable appears at least once in CNF
@@ -18,11 +23,223 @@ def bf_to_phase_oracle(bf_oracle: QuantumCircuit, num_vars: int) -> QuantumCircu
     Args:
         bf_oracle: Bitflip oracle to be converted to a phase oracle
         num_vars: How many variables are taken as input to the oracle"""
-    pass
+    # with the output qubit in |->, flipping it flips the phase instead
+    qc = QuantumCircuit(*bf_oracle.qregs)
+    qc.x(num_vars)
+    qc.h(num_vars)
+    qc.compose(bf_oracle, inplace=True)
+    qc.h(num_vars)
+    qc.x(num_vars)
+    return qc
+
+
+# largest number of variables get_phase_oracle tabulates (a 2^n diagonal)
+MAX_TABLE_VARS = 24
+
+
+def truth_table(cnf: List[List[int]], num_vars: int) -> np.ndarray:
+    """Returns f over all 2^num_vars assignments as a bool array: entry x is f for
+    variable i+1 set to bit i of x (i.e. the basis state x of the input qubits)
+    Args:
+        cnf: Array of clauses of literals
+        num_vars: How many variables are taken as input to the oracle"""
+    assignments = np.arange(2**num_vars, dtype=np.int64)
+    table = np.ones(2**num_vars, dtype=bool)
+    for clause in cnf:
+        # a clause is false exactly when its variables read the negated literals
+        mask = sum(1 << (abs(literal) - 1) for literal in clause)
+        false = sum(1 << (abs(literal) - 1) for literal in clause if literal < 0)
+        table &= (assignments & mask) != false
+    return table
+
+
+def get_phase_oracle(cnf: List[List[int]], num_vars: int) -> QuantumCircuit:
+    """Returns a QuantumCircuit on just the num_vars input qubits that flips the
+    phase if f(x)=1, as one diagonal gate built from truth_table (no output qubit
+    or clause ancillas; simulators apply it in one pass over the state)
+    Args:
+        cnf: Array of clauses of literals
+        num_vars: How many variables are taken as input to the oracle"""
+    if num_vars > MAX_TABLE_VARS:
+        raise ValueError(
+            "%d variables are too many to tabulate (at most %d)" % (num_vars, MAX_TABLE_VARS)
+        )
+    qc = QuantumCircuit(QuantumRegister(num_vars, "input"))
+    qc.append(DiagonalGate(np.where(truth_table(cnf, num_vars), -1.0, 1.0)), qc.qubits)
+    return qc
+
 
-def get_bitflip_oracle(cnf: List[List[int]], num_vars: int) -> QuantumCircuit:
+def _classical_network(circuit: QuantumCircuit, qubits, gates: list) -> bool:
+    """Appends to gates the (control qubits, control states, target) of every X
+    type gate of circuit (qubits[i] is the index of its qubit i), looking inside
+    composite instructions. Returns False if circuit has any other gate"""
+    for instruction in circuit.data:
+        operation = instruction.operation
+        indices = [qubits[circuit.find_bit(qubit).index] for qubit in instruction.qubits]
+        if operation.name == "barrier":
+            continue
+        if isinstance(operation, XGate):
+            gates.append(((), (), indices[0]))
+        elif isinstance(operation, ControlledGate) and operation.base_gate.name == "x":
+            states = [operation.ctrl_state >> i & 1 for i in range(operation.num_ctrl_qubits)]
+            gates.append((indices[:-1], states, indices[-1]))
+        elif operation.definition is None or not _classical_network(
+            operation.definition, indices, gates
+        ):
+            return False
+    return True
+
+
+def verify_bitflip_oracle(bf_oracle: QuantumCircuit, cnf: List[List[int]], num_vars: int) -> List[int]:
+    """Returns the inputs (as ints, see truth_table) on which bf_oracle does not
+    map |x>|0>|0...> to |x>|f(x)>|0...> (up to one global phase for all x), i.e.
+    an empty list for a correct oracle whose ancillas are uncomputed
+    An oracle of X and (multi-)controlled X gates, like get_bitflip_oracle's, is a
+    classical reversible circuit: it runs once on all 2^num_vars inputs at a time,
+    every qubit a bool array over them. Other oracles are simulated per input
+    Args:
+        bf_oracle: Bitflip oracle, e.g. from get_bitflip_oracle
+        cnf: Array of clauses of literals
+        num_vars: How many variables are taken as input to the oracle"""
+    table = truth_table(cnf, num_vars)
+    inputs = np.arange(2**num_vars, dtype=np.int64)
+    gates = []
+    if _classical_network(bf_oracle, range(bf_oracle.num_qubits), gates):
+        bits = [(inputs >> qubit & 1).astype(bool) for qubit in range(num_vars)]
+        bits += [np.zeros(2**num_vars, dtype=bool) for _ in range(num_vars, bf_oracle.num_qubits)]
+        for controls, states, target in gates:
+            fire = np.ones(2**num_vars, dtype=bool)
+            for control, state in zip(controls, states):
+                fire &= bits[control] == state
+            bits[target] ^= fire
+        correct = bits[num_vars] == table
+        for qubit in range(bf_oracle.num_qubits):
+            if qubit != num_vars:
+                expected = inputs >> qubit & 1 if qubit < num_vars else 0
+                correct &= bits[qubit] == expected
+        return [int(value) for value in np.flatnonzero(~correct)]
+    wrong = []
+    phase = None
+    for value in range(2**num_vars):
+        state = Statevector.from_int(value, 2**bf_oracle.num_qubits).evolve(bf_oracle)
+        amplitude = state.data[value | int(table[value]) << num_vars]
+        # a phase that depends on the input (e.g. relative phase Toffolis left
+        # computed) is wrong in superposition, so all must match the first one
+        if phase is None and np.isclose(abs(amplitude), 1):
+            phase = amplitude
+        if phase is None or not np.isclose(amplitude, phase):
+            wrong.append(value)
+    return wrong
+
+
+def _mcx(controls) -> MCXGate:
+    """Returns the MCX over controls, a list of (qubit, state): it flips its target
+    when every control qubit is in its state"""
+    return MCXGate(len(controls), ctrl_state="".join(str(state) for _, state in reversed(controls)))
+
+
+def _clause_gates(clauses: List[List[int]], inputs, ancillas) -> list:
+    """Returns the (gate, qubits) setting ancillas[i] to 1 when clauses[i] is
+    satisfied. All of them are self-inverse, so the same gates in reverse order
+    uncompute the ancillas"""
+    gates = []
+    for clause, ancilla in zip(clauses, ancillas):
+        # the ancilla is flipped when every literal is false, then negated
+        controls = [(inputs[abs(literal) - 1], int(literal < 0)) for literal in clause]
+        gates.append((_mcx(controls), [qubit for qubit, _ in controls] + [ancilla]))
+        gates.append((XGate(), [ancilla]))
+    return gates
+
+
+def _append_and(qc: QuantumCircuit, controls, target):
+    """Appends the MCX flipping target when every (qubit, state) of controls holds"""
+    qc.append(_mcx(controls), [qubit for qubit, _ in controls] + [target])
+
+
+def _batch_size(num_vars: int, num_clauses: int, max_qubits: Optional[int]) -> int:
+    """Returns how many clause ancillas get_bitflip_oracle uses within max_qubits
+    (num_clauses when there is room for all of them)"""
+    if max_qubits is None or num_vars + 1 + num_clauses <= max_qubits:
+        return num_clauses
+    # b clause ancillas plus one ancilla per batch; of the sizes that fit, the
+    # largest needs the fewest batches
+    for size in range(num_clauses - 1, 0, -1):
+        if num_vars + 1 + size + -(-num_clauses // size) <= max_qubits:
+            return size
+    raise ValueError(
+        "%d qubits are not enough for an oracle of %d variables and %d clauses"
+        % (max_qubits, num_vars, num_clauses)
+    )
+
+
+def get_bitflip_oracle(
+    cnf: List[List[int]], num_vars: int, max_qubits: Optional[int] = None
+) -> QuantumCircuit:
     """Returns a QuantumCircuit that flips qubit[num_var] if f(x) = 1
+    Each clause of more than one literal is computed into an ancilla (qubits
+    num_vars+1 onwards), single literal clauses control the output directly.
+    With max_qubits, if there is no room for an ancilla per clause, clauses are
+    computed b at a time into the same b ancillas: the AND of each batch is kept
+    in a batch ancilla and the batch is uncomputed, the output is flipped on the
+    AND of the batch ancillas, which are then uncomputed the same way. That takes
+    num_vars + 1 + b + ceil(clauses / b) qubits for about twice the gates (see
+    oracle_stats to compare configurations)
     Args:
         cnf: Non-empty array of clauses of literals
-        num_vars: How many variables are taken as input to the oracle"""
-    pass
\ No newline at end of file
+        num_vars: How many variables are taken as input to the oracle
+        max_qubits: Most qubits the oracle may use, None for no limit"""
+    inputs = QuantumRegister(num_vars, "input")
+    output = QuantumRegister(1, "output")
+    # identical clauses only need to be checked once
+    clauses = [list(clause) for clause in dict.fromkeys(tuple(clause) for clause in cnf)]
+    direct, computed = {}, []
+    for clause in clauses:
+        if len(clause) == 1 and abs(clause[0]) not in direct:
+            direct[abs(clause[0])] = (inputs[abs(clause[0]) - 1], int(clause[0] > 0))
+        else:
+            computed.append(clause)
+    controls = list(direct.values())
+    size = _batch_size(num_vars, len(computed), max_qubits)
+    if size == len(computed):
+        ancillas = AncillaRegister(size, "clause")
+        qc = QuantumCircuit(inputs, output, ancillas)
+        gates = _clause_gates(computed, inputs, ancillas)
+        for gate, qubits in gates:
+            qc.append(gate, qubits)
+        _append_and(qc, controls + [(ancilla, 1) for ancilla in ancillas], output[0])
+        for gate, qubits in reversed(gates):
+            qc.append(gate, qubits)
+        return qc
+    batches = [computed[start : start + size] for start in range(0, len(computed), size)]
+    ancillas = AncillaRegister(size, "clause")
+    batch_ancillas = AncillaRegister(len(batches), "batch")
+    qc = QuantumCircuit(inputs, output, ancillas, batch_ancillas)
+
+    def compute_batches():
+        # self-inverse: running it again uncomputes the batch ancillas
+        for batch, batch_ancilla in zip(batches, batch_ancillas):
+            gates = _clause_gates(batch, inputs, ancillas)
+            for gate, qubits in gates:
+                qc.append(gate, qubits)
+            _append_and(qc, [(ancilla, 1) for ancilla in ancillas[: len(batch)]], batch_ancilla)
+            for gate, qubits in reversed(gates):
+                qc.append(gate, qubits)
+
+    compute_batches()
+    _append_and(qc, controls + [(ancilla, 1) for ancilla in batch_ancillas], output[0])
+    compute_batches()
+    return qc
+
+
+def oracle_stats(cnf: List[List[int]], num_vars: int, max_qubits: Optional[int] = None) -> dict:
+    """Returns the width ("qubits"), "depth" and number of multi-controlled X gates
+    ("mcx", including cx/ccx) of get_bitflip_oracle(cnf, num_vars, max_qubits),
+    e.g. to pick the fastest configuration that still fits in simulator memory
+    (a statevector takes 16 * 2^qubits bytes)"""
+    qc = get_bitflip_oracle(cnf, num_vars, max_qubits)
+    mcx = sum(
+        1
+        for item in qc.data
+        if isinstance(item.operation, ControlledGate) and item.operation.base_gate.name == "x"
+    )
+    return {"qubits": qc.num_qubits, "depth": qc.depth(), "mcx": mcx}
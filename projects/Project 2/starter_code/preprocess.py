@@ -0,0 +1,136 @@
+from typing import Dict, List, Sequence
+
+# Classical simplification of a CNF before any qubits are spent on it. Every
+# variable that gets fixed or drops out of the formula is one qubit less for
+# oracle.get_bitflip_oracle, counter.quantum_counter and grover.grover
+
+
+class Preprocessed:
+    """A CNF reduced by preprocess, and how to map results back to the original
+
+    Attributes:
+        cnf: reduced clauses over variables 1..num_vars, meeting the oracle
+        restrictions (every variable appears, IDs ascending in each clause)
+        num_vars: number of variables left, i.e. qubits needed for the input
+        original_vars: number of variables of the original CNF
+        variables: variables[i] is the original ID of reduced variable i+1
+        forced: original ID -> value of every variable fixed by the preprocessing
+        free: original IDs of variables that no longer appear in any clause, any
+        value of them is a solution
+        satisfiable: False if the preprocessing found a conflict (then cnf is
+        empty and there are no solutions)"""
+
+    def __init__(self, cnf, num_vars, original_vars, variables, forced, free, satisfiable):
+        self.cnf = cnf
+        self.num_vars = num_vars
+        self.original_vars = original_vars
+        self.variables = variables
+        self.forced = forced
+        self.free = free
+        self.satisfiable = satisfiable
+
+    def solved(self) -> bool:
+        """Returns True if no quantum stage is needed: the instance has no solution,
+        or every assignment of the remaining (free) variables is one"""
+        return not self.satisfiable or not self.cnf
+
+    def lift(self, values: Sequence[int]) -> List[int]:
+        """Returns the assignment of the original variables (index i is variable
+        i+1) for an assignment of the reduced ones; free variables are set to 0
+        Args:
+            values: values[i] is the value (0/1) of reduced variable i+1"""
+        assignment = [0] * self.original_vars
+        for variable, value in self.forced.items():
+            assignment[variable - 1] = int(value)
+        for variable, value in zip(self.variables, values):
+            assignment[variable - 1] = int(value)
+        return assignment
+
+    def lift_bitstring(self, bits: str) -> List[int]:
+        """lift for a measured Qiskit bitstring of the reduced variables (reduced
+        variable 1 is the rightmost character)"""
+        return self.lift([int(bit) for bit in reversed(bits.replace(" ", ""))])
+
+    def num_solutions(self, reduced_solutions: float) -> float:
+        """Returns the number of solutions of the original CNF given the number of
+        solutions (or estimate, e.g. from quantum counting) of the reduced one"""
+        if not self.satisfiable:
+            return 0
+        if not self.cnf:
+            reduced_solutions = 1
+        return reduced_solutions * 2 ** len(self.free)
+
+
+def _assign(clauses, literal):
+    """Returns clauses with literal set to true: satisfied clauses dropped and the
+    negated literal removed from the others"""
+    return {clause - {-literal} for clause in clauses if literal not in clause}
+
+
+def _subsume(clauses):
+    """Returns clauses without those that contain another clause (and are thus
+    implied by it)"""
+    kept = []
+    for clause in sorted(clauses, key=len):
+        if not any(smaller <= clause for smaller in kept):
+            kept.append(clause)
+    return set(kept)
+
+
+def preprocess(
+    cnf: List[List[int]], num_vars: int, pure_literals: bool = False
+) -> Preprocessed:
+    """Returns the CNF simplified by duplicate clause removal, unit propagation,
+    subsumption and (optionally) pure literal elimination, with the remaining
+    variables renumbered to 1..k
+    Pure literal elimination keeps at least one solution if there is one, but not
+    all of them, so it is off by default: solution counts of the reduced CNF then
+    stay exact (see Preprocessed.num_solutions)
+    E.g. preprocess([[1], [2, 3], [-1, -2]], 3): variable 1 is forced to 1, which
+    forces 2 to 0 and 3 to 1, leaving nothing for the quantum stages
+    Args:
+        cnf: Non-empty array of clauses of literals
+        num_vars: How many variables the CNF has
+        pure_literals: Also set variables that appear with one sign only"""
+    # clauses as sets of literals, identical clauses collapse; tautologies (x or
+    # ~x) are always true
+    clauses = {frozenset(clause) for clause in cnf}
+    clauses = {clause for clause in clauses if not any(-literal in clause for literal in clause)}
+    forced: Dict[int, bool] = {}
+    satisfiable = True
+    changed = True
+    while changed and satisfiable:
+        changed = False
+        units = [next(iter(clause)) for clause in clauses if len(clause) == 1]
+        if pure_literals:
+            literals = set().union(*clauses)
+            units += [literal for literal in literals if -literal not in literals]
+        for literal in units:
+            if forced.get(abs(literal), literal > 0) != (literal > 0):
+                satisfiable = False
+                break
+            if abs(literal) in forced:
+                continue
+            forced[abs(literal)] = literal > 0
+            clauses = _assign(clauses, literal)
+            changed = True
+        if frozenset() in clauses:
+            satisfiable = False
+        if satisfiable:
+            reduced = _subsume(clauses)
+            changed = changed or reduced != clauses
+            clauses = reduced
+    if not satisfiable:
+        return Preprocessed([], 0, num_vars, [], forced, [], False)
+    variables = sorted({abs(literal) for clause in clauses for literal in clause})
+    renumber = {variable: index + 1 for index, variable in enumerate(variables)}
+    free = [
+        variable
+        for variable in range(1, num_vars + 1)
+        if variable not in forced and variable not in renumber
+    ]
+    reduced_cnf = sorted(
+        sorted((renumber[abs(literal)] * (1 if literal > 0 else -1) for literal in clause), key=abs)
+        for clause in clauses
+    )
+    return Preprocessed(reduced_cnf, len(variables), num_vars, variables, forced, free, True)
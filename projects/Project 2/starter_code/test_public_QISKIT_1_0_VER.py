@@ -13,7 +13,7 @@ from qiskit import transpile
 import numpy as np
 import math
 
-import driver, oracle, grover, counter
+import driver, oracle, grover, counter, preprocess
 
 # adds classical bits to circuit which is result
 # of measuring select qubits
@@ -61,6 +61,32 @@ class PublicTests(unittest.TestCase):
             print("The autograder is currently limited to Python 3.7.5. Double check that your code will run correctly.")
 
 
+    def test_preprocess(self):
+        # Loris; Claire or Jon; ~Loris or ~Claire; ~Loris or ~Jon; ~Claire or ~Jon
+        # (test_2.csv): unit propagation finds the conflict without any qubit
+        reduced = preprocess.preprocess([[1],[2,3],[-1,-2],[-1,-3],[-2,-3]], 3)
+        self.assertFalse(reduced.satisfiable)
+        self.assertTrue(reduced.solved())
+        self.assertEqual(reduced.num_solutions(0), 0)
+
+        # var1 forces var2, the duplicate and subsumed clauses go, var4 and var6
+        # are free
+        input = [[1],[-1,2],[2,3,4],[3,-5],[3,-5],[-3,5],[3,-5,-6]]
+        reduced = preprocess.preprocess(input, 6)
+        self.assertEqual(reduced.num_vars, 2)
+        self.assertEqual(reduced.variables, [3, 5])
+        self.assertEqual(reduced.cnf, [[-1,2],[1,-2]])
+        self.assertEqual(reduced.free, [4, 6])
+        # the solutions 00 and 11 of the reduced CNF (var3 == var5), 4 times each
+        self.assertEqual(reduced.num_solutions(2), 8)
+        self.assertEqual(reduced.lift_bitstring('11'), [1,1,1,0,1,0])
+
+        # pure literal elimination may drop solutions but keeps one
+        reduced = preprocess.preprocess([[1,2,3],[-2,-3]], 3, pure_literals=True)
+        self.assertTrue(reduced.solved())
+        self.assertEqual(reduced.lift([]), [1,0,0])
+
+
     def test_simple_oracle(self):
         # (var1 or var2) and (~var1 or ~var2)
         # (solutions should be 01 and 10)
@@ -84,6 +110,45 @@ class PublicTests(unittest.TestCase):
         get_circuit_unitary(circ.copy())
 
 
+    def test_batched_oracle(self):
+        # at least two of var1, var2, var3 but not all three
+        # (solutions should be 011, 101 and 110)
+        input = [[1,2],[1,3],[2,3],[-1,-2,-3],[1,2,3],[-1,2,3]]
+        num_vars = 3
+
+        # 3 inputs + output + 6 clause ancillas do not fit, batches of 3 do
+        circ = oracle.get_bitflip_oracle(input, num_vars, max_qubits=9)
+        self.assertEqual(circ.num_qubits, 9)
+        stats = oracle.oracle_stats(input, num_vars, max_qubits=9)
+        self.assertEqual(stats["qubits"], 9)
+        self.assertGreater(stats["mcx"], oracle.oracle_stats(input, num_vars)["mcx"])
+
+        num_shots = 10
+        for value in range(2**num_vars):
+            expected = '1' if value in (0b011, 0b101, 0b110) else '0'
+            counts = test_circuit(circ.copy(), value, {num_vars}, num_shots)
+            self.assertEqual(counts, {expected: num_shots})
+
+    def test_phase_oracle(self):
+        # (var1 or var2) and (~var1 or ~var2)
+        # (solutions should be 01 and 10)
+        input = [[1,2],[-1,-2]]
+        num_vars = 2
+
+        table = oracle.truth_table(input, num_vars)
+        self.assertEqual(list(table), [False, True, True, False])
+        self.assertEqual(oracle.verify_bitflip_oracle(oracle.get_bitflip_oracle(input, num_vars), input, num_vars), [])
+        # a phase on the inputs with var2 set is wrong in superposition
+        bf_oracle = oracle.get_bitflip_oracle(input, num_vars)
+        bf_oracle.s(1)
+        self.assertEqual(oracle.verify_bitflip_oracle(bf_oracle, input, num_vars), [2, 3])
+
+        # one diagonal gate on the input qubits only
+        circ = oracle.get_phase_oracle(input, num_vars)
+        self.assertEqual(circ.num_qubits, num_vars)
+        mat = get_circuit_unitary(circ.copy())
+        self.assertTrue(np.allclose(mat, np.diag([1, -1, -1, 1])))
+
     def test_simple_grover(self):
         # (var1) and (var2)
         # (solutions should be 11)
@@ -116,4 +181,44 @@ class PublicTests(unittest.TestCase):
         get_circuit_unitary(circ.copy())
 
 
-    
\ No newline at end of file
+    
+
+    def test_emulated_count(self):
+        # same instance as test_simple_count, 4 solutions out of 8
+        input = [[1,-2],[2,3]]
+        num_vars = 3
+        precision = 3
+
+        probabilities = counter.count_distribution(4, num_vars, precision)
+        self.assertTrue(np.allclose(probabilities, [0, 0, 0.5, 0, 0, 0, 0.5, 0]))
+
+        counts = counter.emulate_counter(input, num_vars, precision, 1000, rng=0)
+        result = max(counts, key=counts.get)
+        self.assertTrue(result == '010' or result == '110')
+        self.assertAlmostEqual(counter.estimate_solutions(result, num_vars, precision), 4)
+
+        # large precision only costs 2^precision
+        counts = counter.emulate_counter(input, num_vars, 16, 1000, rng=0)
+        self.assertEqual(sum(counts.values()), 1000)
+
+    def test_iterative_count(self):
+        # same instance as test_simple_count, 4 solutions out of 8
+        input = [[1,-2],[2,3]]
+        num_vars = 3
+
+        # one control qubit whatever the precision
+        circ = counter.iterative_quantum_counter(input, num_vars, 4)
+        self.assertEqual(circ.num_qubits, 1 + num_vars)
+
+        def run(circ, num_shots):
+            sim = AerSimulator()
+            new_circuit = transpile(circ, sim)
+            return sim.run(new_circuit, shots=num_shots).result().get_counts()
+
+        # theta = pi/4 exactly, every precision measures k = 2^t / 4 or 3 * 2^t / 4
+        solutions, iterations, precision = counter.iterative_count(input, num_vars, 4, 100, run=run)
+        self.assertAlmostEqual(solutions, 4)
+        self.assertEqual(iterations, 1)
+        self.assertEqual(precision, 4)
+        with self.assertRaises(ValueError):
+            counter.iterative_count(input, num_vars, 0, 100, run=run)
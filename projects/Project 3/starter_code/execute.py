@@ -1,15 +1,174 @@
-from qiskit import Aer
-from qiskit.providers.aer import AerSimulator
-from qiskit import execute
-from qiskit.providers.aer.noise import *
-from qiskit.circuit import *
-from typing import Dict
-
-def run_sim(qc: QuantumCircuit, num_shots: int) -> Dict[str, int]: 
-    # If you want, you can adjust NoiseModel() to insert random errors automatically
-    # However, since we are only implementing a subset of fault-tolerant procedures
-    # (e.g. ancilla bits may not be initialized properly), we may observe that
-    # not all single bit errors are always corrected
-    sim = AerSimulator(noise_model=NoiseModel())
-    result = execute(qc, backend=sim, shots=num_shots, optimization_level=0).result()
-    return result.get_counts()
\ No newline at end of file
+from qiskit import Aer
+from qiskit.providers.aer import AerSimulator
+from qiskit import transpile
+from qiskit.providers.aer.noise import *
+from qiskit.circuit import *
+from qiskit.circuit.library import get_standard_gate_name_mapping
+from typing import Dict, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, namedtuple
+
+import multiprocessing
+
+import numpy as np
+
+# transpiled circuits kept by run_sim, least recently used ones are dropped first
+CACHE_SIZE = 64
+
+# instructions that need no definition to be recognized by transpile
+STANDARD_NAMES = set(get_standard_gate_name_mapping()) | {"measure", "reset", "barrier"}
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+_simulator = None
+_transpiled = OrderedDict()
+_hits = 0
+_misses = 0
+
+
+def _simulator_instance() -> AerSimulator:
+    global _simulator
+    if _simulator is None:
+        _simulator = AerSimulator(noise_model=NoiseModel())
+    return _simulator
+
+
+def _parameter(value):
+    if isinstance(value, QuantumCircuit):
+        return _structure(value)
+    if isinstance(value, np.ndarray):
+        return (value.shape, tuple(value.flat))
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def _structure(qc: QuantumCircuit) -> tuple:
+    """Returns a hashable description of everything in qc that transpile and the
+    counts depend on: registers, and every instruction (name, parameters, bits,
+    condition, and the definition of composite instructions such as the p3
+    gadgets) with bits as indices. Names, metadata and bit objects are left out,
+    so rebuilding the same circuit gives the same key"""
+    index = lambda bit: qc.find_bit(bit).index
+    instructions = []
+    for item in qc.data:
+        operation = item.operation
+        condition = getattr(operation, "condition", None)
+        if condition is not None:
+            target, value = condition if isinstance(condition, tuple) else (condition, None)
+            if isinstance(target, Clbit):
+                target = index(target)
+            elif isinstance(target, ClassicalRegister):
+                target = tuple(index(bit) for bit in target)
+            else:
+                target = repr(target)
+            condition = (target, value)
+        name, definition = operation.name, None
+        if name not in STANDARD_NAMES and not hasattr(operation, "blocks"):
+            # the name of a composite instruction is a generated "circuit-<n>"
+            # unique to every instance, what it does is its definition
+            definition = operation.definition
+            if definition is not None:
+                name = None
+        instructions.append((
+            name,
+            tuple(_parameter(param) for param in operation.params),
+            tuple(index(qubit) for qubit in item.qubits),
+            tuple(index(clbit) for clbit in item.clbits),
+            condition,
+            None if definition is None else _structure(definition),
+        ))
+    return (
+        qc.num_qubits,
+        tuple((register.name, register.size) for register in qc.cregs),
+        tuple(instructions),
+    )
+
+
+def cache_info() -> CacheInfo:
+    """Returns the hits and misses of run_sim's transpile cache so far, as
+    functools.lru_cache does"""
+    return CacheInfo(_hits, _misses, CACHE_SIZE, len(_transpiled))
+
+
+def cache_clear():
+    global _hits, _misses
+    _transpiled.clear()
+    _hits = _misses = 0
+
+
+def _transpile(qc: QuantumCircuit, key=None) -> QuantumCircuit:
+    """Returns qc transpiled for the shared simulator, from the cache if a circuit
+    with the same structure was transpiled recently"""
+    global _hits, _misses
+    key = _structure(qc) if key is None else key
+    transpiled = _transpiled.get(key)
+    if transpiled is None:
+        _misses += 1
+        transpiled = transpile(qc, _simulator_instance(), optimization_level=0)
+        _transpiled[key] = transpiled
+        while len(_transpiled) > CACHE_SIZE:
+            _transpiled.popitem(last=False)
+    else:
+        _hits += 1
+        _transpiled.move_to_end(key)
+    return transpiled
+
+
+def run_sim(qc: QuantumCircuit, num_shots: int) -> Dict[str, int]:
+    # If you want, you can adjust NoiseModel() to insert random errors automatically
+    # However, since we are only implementing a subset of fault-tolerant procedures
+    # (e.g. ancilla bits may not be initialized properly), we may observe that
+    # not all single bit errors are always corrected
+    # The simulator is created once, and circuits with the same structure as one of
+    # the last CACHE_SIZE circuits reuse its transpiled version (see cache_info)
+    sim = _simulator_instance()
+    transpiled = _transpile(qc)
+    result = sim.run(transpiled, shots=num_shots).result()
+    return result.get_counts(transpiled)
+
+
+def _run_chunk(circuits, num_shots):
+    """Runs circuits as one job in a worker process of run_sim_batch"""
+    sim = _simulator_instance()
+    transpiled = [_transpile(qc) for qc in circuits]
+    result = sim.run(transpiled, shots=num_shots).result()
+    return [result.get_counts(index) for index in range(len(transpiled))]
+
+
+def run_sim_batch(circuits, num_shots: int, max_workers=None) -> Iterator[Dict[str, int]]:
+    """Runs every circuit of circuits (e.g. the variants of a fault injection sweep)
+    for num_shots shots, and yields their counts in order, as run_sim would
+
+    By default all circuits are transpiled in this process (once per structure)
+    and run as a single simulator job, whose experiments Aer runs in parallel on
+    all cores (max_parallel_experiments=0). With max_workers > 1, structurally different circuits are instead
+    split into chunks over a pool of that many processes, which transpile and
+    run them in parallel; the counts of a chunk are yielded as soon as it and the
+    chunks before it are done. The pool starts fresh interpreters that import the
+    calling module, so a script using it must guard its top level code with
+    if __name__ == "__main__":
+    E.g. for counts in run_sim_batch(variants, 100, max_workers=os.cpu_count()): ..."""
+    circuits = list(circuits)
+    keys = [_structure(qc) for qc in circuits]
+    workers = max_workers or 1
+    if len(set(keys)) <= 1 or workers == 1 or len(circuits) == 1:
+        sim = _simulator_instance()
+        transpiled = [_transpile(qc, key) for qc, key in zip(circuits, keys)]
+        if transpiled:
+            result = sim.run(
+                transpiled, shots=num_shots, max_parallel_experiments=0
+            ).result()
+            for index in range(len(transpiled)):
+                yield result.get_counts(index)
+        return
+    # a few chunks per worker keeps them all busy when some circuits are slower
+    size = -(-len(circuits) // (4 * workers))
+    chunks = [circuits[start : start + size] for start in range(0, len(circuits), size)]
+    # fresh processes: forking after Aer has started its OpenMP threads can hang
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        for counts in pool.map(_run_chunk, chunks, [num_shots] * len(chunks)):
+            yield from counts
@@ -2,7 +2,40 @@ from qiskit import *
 import numpy as np
 from qiskit.circuit import *
 from qiskit.quantum_info import Statevector
+import functools
 
+# gates the pre-decomposed gadgets (gadget.basis()) are expressed in, all native
+# to AerSimulator
+BASIS_GATES = ["u", "cx", "measure", "reset", "if_else"]
+
+
+def _gadget(build):
+    """Builds a gadget once per process: every call returns a copy of the cached
+    Instruction (so callers may modify it, e.g. its label, without affecting later
+    calls), and gadget.basis() returns the same gadget with its definition already
+    decomposed to BASIS_GATES, so transpile only has to inline it"""
+    cache = {}
+
+    @functools.wraps(build)
+    def gadget():
+        if "instruction" not in cache:
+            cache["instruction"] = build()
+        return cache["instruction"].copy()
+
+    def basis():
+        if "basis" not in cache:
+            instruction = gadget()
+            definition = transpile(
+                instruction.definition, basis_gates=BASIS_GATES, optimization_level=0
+            )
+            cache["basis"] = definition.to_instruction(label=instruction.label)
+        return cache["basis"].copy()
+
+    gadget.basis = basis
+    return gadget
+
+
+@_gadget
 def error_correct() -> Instruction:
     """Returns a circuit (7 code qubits, 3 ancilla bits, 3 classical bits) which
     corrects an arbitrary single-bit error on a Steane encoding
@@ -25,9 +58,67 @@ def decode_measurement(code: str) -> int:
     E.g. decode_measurement("1100110") -> 0 (no correction, valid codeword for 0)
     Args:
         code: String corresponding to measurement (most significant bit at LOWER index)"""
-    pass
+    return int(DECODE_LOGICAL[int(code.replace(" ", ""), 2)])
+
+
+def _decode_table():
+    """Returns the logical value, syndrome and corrected codeword of all 128 Steane
+    measurements, indexed by the measurement as an int (int(code, 2))
+
+    Bit k of the int (string index 6-k) is position k+1 of the Hamming code: the
+    syndrome is the XOR of the positions of the 1 bits, a non-zero syndrome is the
+    position of the flipped bit, and the logical value is the parity of the
+    corrected codeword"""
+    codes = np.arange(128)
+    bits = codes[:, np.newaxis] >> np.arange(7) & 1
+    syndromes = np.bitwise_xor.reduce(bits * np.arange(1, 8), axis=1)
+    corrected = np.where(syndromes, codes ^ (1 << syndromes - 1), codes)
+    logical = bits.sum(axis=1) % 2 ^ (syndromes != 0)
+    return logical.astype(np.uint8), syndromes.astype(np.uint8), corrected
+
+
+DECODE_LOGICAL, DECODE_SYNDROME, DECODE_CORRECTED = _decode_table()
+
+
+def decode_counts(counts, code_clbits=range(7)):
+    """Decodes a whole histogram of Steane measurements at once
+    E.g. decode_counts({"1100001": 90, "1101001": 10})
+        -> ({0: 0, 1: 100}, {0: 90, 1: 0, 2: 0, 3: 0, 4: 10, 5: 0, 6: 0, 7: 0})
+    Args:
+        counts: Dict of measurement (bit string, spaces allowed, or hex string as
+        in raw Aer results) to count, or numpy array of int-encoded measurements
+        (one per shot)
+        code_clbits: clbits holding the Steane measurement, as bit positions of the
+        outcomes, first one least significant (i.e. Hamming position 1)
+    Returns: (logical histogram, histogram of syndromes) as dicts, syndrome s > 0
+        means the bit at Hamming position s (string index 7-s) was flipped"""
+    if isinstance(counts, dict):
+        outcomes = np.array(
+            [int(key, 16) if key.startswith("0x") else int(key.replace(" ", ""), 2)
+             for key in counts],
+            dtype=object,
+        )
+        weights = np.array(list(counts.values()), dtype=np.int64)
+    else:
+        outcomes, weights = np.asarray(counts), None
+    code_clbits = list(code_clbits)
+    if code_clbits == list(range(7)):
+        codes = outcomes & 127
+    else:
+        codes = 0
+        for rank, clbit in enumerate(code_clbits):
+            codes = codes | (outcomes >> clbit & 1) << rank
+    # histogram of the 128 codewords, then the table does the rest
+    codewords = np.bincount(codes.astype(np.int64), weights, minlength=128)
+    logical = np.bincount(DECODE_LOGICAL, codewords, minlength=2)
+    syndromes = np.bincount(DECODE_SYNDROME, codewords, minlength=8)
+    return (
+        {value: int(count) for value, count in enumerate(logical)},
+        {value: int(count) for value, count in enumerate(syndromes)},
+    )
 
 
+@_gadget
 def FT_X() -> Instruction:
     """Returns 7 qubit circuit implementing fault tolerant X gate using Steane code"""
     qc = QuantumCircuit(7)
@@ -35,6 +126,7 @@ def FT_X() -> Instruction:
     return qc.to_instruction(label="FT_X")
 
 
+@_gadget
 def FT_Y() -> Instruction:
     """Returns 7 qubit circuit implementing fault tolerant Y gate using Steane code"""
     qc = QuantumCircuit(7)
@@ -42,12 +134,14 @@ def FT_Y() -> Instruction:
     return qc.to_instruction(label="FT_Y")
 
 
+@_gadget
 def FT_Z() -> Instruction:
     """Returns 7 qubit circuit implementing fault tolerant Z gate using Steane code"""
     qc = QuantumCircuit(7)
     # your code here
     return qc.to_instruction(label="FT_Z")
 
+@_gadget
 def FT_H() -> Instruction:
     """Returns 7 qubit circuit implementing fault tolerant H gate using Steane code"""
     qc = QuantumCircuit(7)
@@ -55,12 +149,14 @@ def FT_H() -> Instruction:
     return qc.to_instruction(label="FT_H")
 
 
+@_gadget
 def FT_S() -> Instruction:
     """Returns 7 qubit circuit implementing fault tolerant S gate using Steane code"""
     qc = QuantumCircuit(7)
     # your code here
     return qc.to_instruction(label="FT_S")
     
+@_gadget
 def FT_T() -> Instruction:
     """Returns a circuit (7 code qubits, 7 ancilla bits, 1 classical bit) implementing
     fault tolerant T gate using Steane code
@@ -77,6 +173,7 @@ def FT_T() -> Instruction:
     return qc.to_instruction(label="FT_T")
 
 
+@_gadget
 def FT_CX() -> Instruction:
     """Returns 14 qubit circuit implementing fault tolerant CX gate using Steane code
     7 least significant qubits correspond to logical qubit 0 which acts as the control
@@ -0,0 +1,279 @@
+from qiskit.circuit import *
+from qiskit.quantum_info import StabilizerState
+import numpy as np
+
+# how each Clifford gate moves the X and Z parts of a Pauli frame; Pauli gates
+# (and id) commute with the frame up to a sign, which the frame does not track
+FRAME_GATES = {"h", "s", "sdg", "x", "y", "z", "id", "cx", "cz", "swap"}
+
+PAULI_GATES = {"x", "y", "z", "id"}
+
+ALL_ONES = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def _flatten(circuit, qubits, clbits):
+    """Returns the instructions of circuit, with every composite instruction (e.g.
+    the gadgets of p3) expanded, as (name, qubits, clbits, operation) tuples using
+    the qubit/clbit indices of the outermost circuit"""
+    program = []
+    for item in circuit.data:
+        operation = item.operation
+        name = operation.name
+        targets = [qubits[circuit.find_bit(qubit).index] for qubit in item.qubits]
+        bits = [clbits[circuit.find_bit(clbit).index] for clbit in item.clbits]
+        if name in ("barrier", "delay"):
+            continue
+        if name in FRAME_GATES or name in ("measure", "reset"):
+            program.append((name, targets, bits, operation))
+        elif name == "if_else":
+            if not isinstance(operation.condition, tuple):
+                raise ValueError(
+                    "Only (clbit or register, value) conditions are supported, "
+                    "not expressions"
+                )
+            target, value = operation.condition
+            if isinstance(target, Clbit):
+                condition = [clbits[circuit.find_bit(target).index]]
+            elif isinstance(target, ClassicalRegister):
+                condition = [clbits[circuit.find_bit(bit).index] for bit in target]
+            else:
+                raise ValueError("Only clbit and register conditions are supported")
+            if operation.blocks[1:] and operation.blocks[1].data:
+                raise ValueError("else branches are not supported")
+            body = operation.blocks[0]
+            body = _flatten(body, targets, bits)
+            if any(instruction[0] not in PAULI_GATES for instruction in body):
+                raise ValueError("Only Pauli corrections can be classically controlled")
+            program.append((name, targets, condition, (value, body)))
+        elif operation.definition is not None:
+            program.extend(_flatten(operation.definition, targets, bits))
+        else:
+            raise ValueError(f"{name} is not a gate the Pauli frame simulator supports")
+    return program
+
+
+def _positions(rng, probability, shots):
+    """Returns the sorted shots (lanes) hit by an event of the given probability"""
+    if probability <= 0:
+        return np.zeros(0, dtype=np.int64)
+    count = rng.binomial(shots, probability)
+    return np.sort(rng.choice(shots, count, replace=False))
+
+
+def _mask(positions, words):
+    """Returns the packed lanes with the bits at positions set"""
+    mask = np.zeros(words, dtype=np.uint64)
+    bits = np.left_shift(np.uint64(1), (positions & 63).astype(np.uint64))
+    np.bitwise_or.at(mask, positions >> 6, bits)
+    return mask
+
+
+def _random_lanes(rng, words):
+    """Returns packed lanes with every bit set independently with probability 1/2"""
+    return rng.integers(0, ALL_ONES, words, dtype=np.uint64, endpoint=True)
+
+
+def popcount(lanes):
+    """Returns the number of set bits of the uint64 array lanes"""
+    return int(np.unpackbits(lanes.view(np.uint8)).sum(dtype=np.int64))
+
+
+class PauliFrameSimulator:
+    """Monte Carlo simulator of noisy Clifford circuits with measurements, resets and
+    classically controlled Pauli corrections (e.g. the Steane gadgets of p3)
+
+    One noiseless reference run is made with a stabilizer state. Each shot then
+    only tracks the Pauli error (frame) that separates it from the reference: X/Z
+    frame bits are pushed through the Clifford gates, sampled errors are XORed
+    into them and a measurement reads the reference result XOR the X frame. The
+    frames of 64 shots are packed into every uint64, so a gate costs a few bitwise
+    operations over shots / 64 words. As in Stim, the Z frames of freshly reset or
+    measured qubits are randomized, which makes random outcomes random per shot.
+
+    Noise (all probabilities, 0 by default):
+        depolarizing: after each gate, a uniformly random non-identity Pauli on its
+        qubits (3 for one qubit gates, 15 for two qubit gates)
+        bit_flip: after each gate and reset, an X on each of its qubits
+        measurement: a flipped measurement result
+
+    Args:
+        circuit: QuantumCircuit of the gates in FRAME_GATES, measure, reset and
+        if_test blocks of Pauli gates, or composite instructions of those
+
+        Example:
+            simulator = PauliFrameSimulator(qc, depolarizing=1e-3, seed=1)
+            record = simulator.sample(10**6) # packed measurement results
+    """
+
+    def __init__(self, circuit, depolarizing=0.0, bit_flip=0.0, measurement=0.0, seed=None):
+        self.num_qubits = circuit.num_qubits
+        self.num_clbits = circuit.num_clbits
+        self.depolarizing = depolarizing
+        self.bit_flip = bit_flip
+        self.measurement = measurement
+        self.rng = np.random.default_rng(seed)
+        self.program = _flatten(
+            circuit, list(range(self.num_qubits)), list(range(self.num_clbits))
+        )
+        self.reference = self._reference_sample()
+
+    def _reference_sample(self):
+        """Returns the clbits (uint8 array) of one noiseless run, and records the
+        value of every condition in it"""
+        state = StabilizerState(QuantumCircuit(self.num_qubits))
+        record = np.zeros(self.num_clbits, dtype=np.uint8)
+        self._reference_conditions = []
+        for name, qubits, clbits, operation in self.program:
+            if name == "measure":
+                # the collapsed state is a copy, so hand it our generator on each
+                # measurement for seeded runs to stay reproducible
+                state.seed(self.rng)
+                outcome, state = state.measure(qubits)
+                record[clbits[0]] = int(outcome)
+            elif name == "reset":
+                state = state.reset(qubits)
+            elif name == "if_else":
+                value, body = operation
+                taken = _condition_value(record, clbits) == value
+                self._reference_conditions.append(taken)
+                if taken:
+                    for _, body_qubits, _, gate in body:
+                        state = state.evolve(gate, body_qubits)
+            else:
+                state = state.evolve(operation, qubits)
+        return record
+
+    def sample(self, shots):
+        """Runs shots noisy shots
+
+        Returns: (num_clbits, ceil(shots / 64)) uint64 array, bit j of word w of row
+            c is clbit c of shot 64 w + j (bits past shots are garbage)"""
+        rng = self.rng
+        words = (shots + 63) // 64
+        x = np.zeros((self.num_qubits, words), dtype=np.uint64)
+        z = np.zeros((self.num_qubits, words), dtype=np.uint64)
+        # every qubit starts out freshly reset
+        for qubit in range(self.num_qubits):
+            z[qubit] = _random_lanes(rng, words)
+        record = np.zeros((self.num_clbits, words), dtype=np.uint64)
+        reference = np.where(self.reference, ALL_ONES, np.uint64(0))
+        conditions = iter(self._reference_conditions)
+        for name, qubits, clbits, operation in self.program:
+            if name == "measure":
+                qubit, clbit = qubits[0], clbits[0]
+                record[clbit] = x[qubit] ^ reference[clbit]
+                if self.measurement:
+                    record[clbit] ^= _mask(_positions(rng, self.measurement, shots), words)
+                z[qubit] = _random_lanes(rng, words)
+                continue
+            if name == "reset":
+                x[qubits[0]] = 0
+                z[qubits[0]] = _random_lanes(rng, words)
+                self._bit_flips(x, qubits, shots, words)
+                continue
+            if name == "if_else":
+                value, body = operation
+                # shots whose condition differs from the reference's apply the
+                # correction when the reference does not, or the other way around
+                taken = _condition_lanes(record, clbits, value)
+                differs = taken ^ (ALL_ONES if next(conditions) else np.uint64(0))
+                for gate, body_qubits, _, _ in body:
+                    if gate in ("x", "y"):
+                        x[body_qubits[0]] ^= differs
+                    if gate in ("z", "y"):
+                        z[body_qubits[0]] ^= differs
+                continue
+            if name == "h":
+                q = qubits[0]
+                x[q], z[q] = z[q].copy(), x[q].copy()
+            elif name in ("s", "sdg"):
+                z[qubits[0]] ^= x[qubits[0]]
+            elif name == "cx":
+                control, target = qubits
+                x[target] ^= x[control]
+                z[control] ^= z[target]
+            elif name == "cz":
+                a, b = qubits
+                z[a] ^= x[b]
+                z[b] ^= x[a]
+            elif name == "swap":
+                a, b = qubits
+                x[[a, b]] = x[[b, a]]
+                z[[a, b]] = z[[b, a]]
+            self._depolarize(x, z, qubits, shots, words)
+            self._bit_flips(x, qubits, shots, words)
+        return record
+
+    def _depolarize(self, x, z, qubits, shots, words):
+        positions = _positions(self.rng, self.depolarizing, shots)
+        if not len(positions):
+            return
+        # a non-zero 2k bit number per hit shot: bit 2i flips X, 2i+1 Z of qubit i
+        paulis = self.rng.integers(1, 4 ** len(qubits), len(positions))
+        for rank, qubit in enumerate(qubits):
+            x[qubit] ^= _mask(positions[paulis >> (2 * rank) & 1 == 1], words)
+            z[qubit] ^= _mask(positions[paulis >> (2 * rank + 1) & 1 == 1], words)
+
+    def _bit_flips(self, x, qubits, shots, words):
+        if self.bit_flip:
+            for qubit in qubits:
+                x[qubit] ^= _mask(_positions(self.rng, self.bit_flip, shots), words)
+
+
+def _condition_value(record, clbits):
+    """Value of the classical register made of clbits (first least significant)"""
+    return sum(int(record[clbit]) << rank for rank, clbit in enumerate(clbits))
+
+
+def _condition_lanes(record, clbits, value):
+    """Returns the packed lanes of the shots whose clbits read value"""
+    lanes = np.full(record.shape[1], ALL_ONES)
+    for rank, clbit in enumerate(clbits):
+        lanes &= record[clbit] if value >> rank & 1 else ~record[clbit]
+    return lanes
+
+
+def steane_logical(record, code_clbits=range(7)):
+    """Returns the packed logical values of Steane code measurements in record
+
+    Clbit code_clbits[k] is position k+1 of the Hamming code: the syndrome is the
+    XOR of the positions of the 1 bits, a non-zero syndrome flips that position,
+    and the logical value is the parity of the corrected codeword."""
+    rows = record[list(code_clbits)]
+    parity = np.bitwise_xor.reduce(rows, axis=0)
+    syndrome = [
+        np.bitwise_xor.reduce(rows[[k for k in range(7) if (k + 1) >> bit & 1]], axis=0)
+        for bit in range(3)
+    ]
+    # any syndrome means a single bit was corrected, which flips the parity
+    return parity ^ (syndrome[0] | syndrome[1] | syndrome[2])
+
+
+def logical_failure_rate(
+    circuit, shots, code_clbits=range(7), expected=None, batch_shots=2**20, **noise
+):
+    """Returns the fraction of shots whose Steane-decoded logical measurement (of
+    code_clbits, see steane_logical) differs from expected
+
+    Args:
+        circuit: QuantumCircuit ending with a measurement of the code qubits
+        expected: logical value of a noiseless run, taken from the reference run
+        if None
+        batch_shots: shots simulated at once, bounds the memory used
+        noise: depolarizing/bit_flip/measurement probabilities and seed, see
+        PauliFrameSimulator"""
+    simulator = PauliFrameSimulator(circuit, **noise)
+    if expected is None:
+        reference = np.where(simulator.reference, ALL_ONES, np.uint64(0))
+        expected = int(steane_logical(reference[:, np.newaxis], code_clbits)[0] & 1)
+    failures = 0
+    for start in range(0, shots, batch_shots):
+        batch = min(batch_shots, shots - start)
+        logical = steane_logical(simulator.sample(batch), code_clbits)
+        if expected:
+            logical = ~logical
+        # clear the garbage lanes past the last shot
+        if batch % 64:
+            logical[-1] &= np.uint64((1 << (batch % 64)) - 1)
+        failures += popcount(logical)
+    return failures / shots
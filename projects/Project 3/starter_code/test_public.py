@@ -1,11 +1,14 @@
 import unittest
 
 from qiskit.circuit import *
+from qiskit.circuit.classical import expr
 
 from typing import Dict
 
+import numpy as np
 
-import p3, execute
+
+import p3, execute, pauli_frame
 
 class TestPublic(unittest.TestCase):
     
@@ -48,9 +51,96 @@ class TestPublic(unittest.TestCase):
 
         # ensure every result corresponds to a valid 0 state
         # (after error correction)
-        for result in list(counts):
-            trimmed_result = result.replace(" ","")
-            self.assertEqual(p3.decode_measurement(trimmed_result),0)
+        logical, syndromes = p3.decode_counts(counts)
+        self.assertEqual(logical, {0: 100, 1: 0})
+
+    def test_decode_counts(self):
+        logical, syndromes = p3.decode_counts({"1100001": 90, "1101001": 10})
+        self.assertEqual(logical, {0: 0, 1: 100})
+        self.assertEqual(syndromes, {0: 90, 1: 0, 2: 0, 3: 0, 4: 10, 5: 0, 6: 0, 7: 0})
+        # int-encoded shots agree with decode_measurement on every codeword
+        outcomes = np.arange(128).repeat(3)
+        logical, syndromes = p3.decode_counts(outcomes)
+        ones = sum(p3.decode_measurement(format(code, "07b")) for code in range(128))
+        self.assertEqual(logical, {0: 3 * (128 - ones), 1: 3 * ones})
+        self.assertEqual(set(syndromes.values()), {48})
+
+    def test_run_sim_cache(self):
+        def circuit(error):
+            # a fresh composite instruction every time, like a rebuilt gadget
+            encode = QuantumCircuit(7, name='encode')
+            encode.h(0)
+            encode.cx(0, range(1, 7))
+            qc = QuantumCircuit(QuantumRegister(7, 'code'), ClassicalRegister(7, 'result'))
+            qc.append(encode.to_instruction(), qc.qubits)
+            qc.x(error)
+            qc.measure(range(7), range(7))
+            return qc
+
+        execute.cache_clear()
+        for error in range(7):
+            execute.run_sim(circuit(error), 10)
+        # rebuilt circuits hit the cache: composite instructions are keyed on
+        # their definition, not on the instance
+        for error in range(7):
+            counts = execute.run_sim(circuit(error), 10)
+        self.assertEqual(execute.cache_info().misses, 7)
+        self.assertEqual(execute.cache_info().hits, 7)
+        self.assertEqual(sum(counts.values()), 10)
+
+    def test_run_sim_batch(self):
+        circuits = []
+        for error in range(7):
+            qc = QuantumCircuit(QuantumRegister(7, 'code'), ClassicalRegister(7, 'result'))
+            qc.x(error)
+            qc.measure(range(7), range(7))
+            circuits.append(qc)
+        expected = [execute.run_sim(qc, 10) for qc in circuits]
+        # results come back in order, from one job or from the process pool
+        self.assertEqual(list(execute.run_sim_batch(circuits, 10, max_workers=1)), expected)
+        self.assertEqual(list(execute.run_sim_batch(circuits, 10, max_workers=2)), expected)
+        self.assertEqual(list(execute.run_sim_batch(circuits[:1] * 3, 10)), expected[:1] * 3)
+
+    def test_gadget_library(self):
+        for gadget in (p3.error_correct, p3.FT_X, p3.FT_H, p3.FT_T, p3.FT_CX):
+            # built once, but every call gets its own copy
+            self.assertIsNot(gadget(), gadget())
+            self.assertEqual(gadget(), gadget())
+            self.assertEqual(gadget.basis(), gadget.basis())
+            changed = gadget()
+            changed.label = "changed"
+            self.assertNotEqual(gadget().label, "changed")
+            self.assertEqual(gadget.basis().num_qubits, gadget().num_qubits)
+            self.assertEqual(gadget.basis().num_clbits, gadget().num_clbits)
+            self.assertLessEqual(set(gadget.basis().definition.count_ops()), set(p3.BASIS_GATES))
+
+    def test_pauli_frame(self):
+        # Steane |0>_L: qubit k is Hamming position k+1, H on positions 1, 2 and 4
+        # then CX to the other positions of their parity checks
+        qc = QuantumCircuit(7, 7)
+        for pivot in (1, 2, 4):
+            qc.h(pivot - 1)
+        for pivot in (1, 2, 4):
+            for position in range(1, 8):
+                if position & pivot and position != pivot:
+                    qc.cx(pivot - 1, position - 1)
+        qc.measure(range(7), range(7))
+        self.assertEqual(pauli_frame.logical_failure_rate(qc, 10**5, seed=1), 0)
+        # single measurement errors are corrected, only pairs (~21 p^2) fail
+        rate = pauli_frame.logical_failure_rate(qc, 10**6, measurement=0.01, seed=1)
+        self.assertGreater(rate, 0.001)
+        self.assertLess(rate, 0.003)
+        # the noiseless reference run draws its random outcomes from the seed too
+        runs = [pauli_frame.PauliFrameSimulator(qc, seed=1).sample(64) for _ in range(5)]
+        for record in runs[1:]:
+            self.assertTrue(np.array_equal(record, runs[0]))
+        # expression conditions are rejected up front
+        qc = QuantumCircuit(1, 1)
+        qc.measure(0, 0)
+        with qc.if_test(expr.logic_not(qc.clbits[0])):
+            qc.x(0)
+        with self.assertRaises(ValueError):
+            pauli_frame.PauliFrameSimulator(qc)
             
 if __name__ == "__main__":
 	unittest.main()
\ No newline at end of file